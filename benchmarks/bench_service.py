@@ -0,0 +1,305 @@
+"""Benchmarks for the coil update -> MQTT publish path and the poller.
+
+Drives a real Service with a simulated heat pump connection and an in-memory MQTT client:
+
+    python -m benchmarks.bench_service --updates 20000 --coils 300 --latency 0.02
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import random
+import statistics
+import time
+import tracemalloc
+from types import SimpleNamespace
+from unittest import mock
+
+from nibe.coil import Coil, CoilData
+from nibe.connection import Connection
+from nibe.heatpump import HeatPump, Model
+
+from nibe_mqtt.config import schema
+from nibe_mqtt.heatpump import LazyHeatPump
+from nibe_mqtt.mqtt import MqttConnection
+from nibe_mqtt.service import PollService, Service
+
+
+class SimulatedConnection(Connection):
+    """Heat pump connection answering reads after a fixed bus latency.
+
+    By default one request is served at a time, like the NibeGW connection does."""
+
+    def __init__(self, heatpump: HeatPump, latency: float, bus_slots: int = 1):
+        self._heatpump = heatpump
+        self._latency = latency
+        self._lock = asyncio.Semaphore(bus_slots)
+        self.reads = 0
+
+    async def read_coil(self, coil: Coil, timeout: float = 5) -> CoilData:
+        async with self._lock:
+            if self._latency:
+                await asyncio.sleep(self._latency)
+            self.reads += 1
+            coil_data = CoilData(coil, random_value(coil))
+            self._heatpump.notify_coil_update(coil_data)
+            return coil_data
+
+    async def write_coil(self, coil_data: CoilData, timeout: float = 5) -> None:
+        async with self._lock:
+            await asyncio.sleep(self._latency)
+
+    async def verify_connectivity(self):
+        pass
+
+
+class InMemoryClient:
+    """Stand-in for paho Client recording publish times."""
+
+    PUBLISHED = SimpleNamespace(rc=0)
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((time.perf_counter(), topic, payload))
+        return self.PUBLISHED
+
+    def __getattr__(self, name):
+        return mock.Mock()
+
+
+def random_value(coil: Coil):
+    if coil.has_mappings:
+        return random.choice(list(coil.reverse_mappings))
+    if coil.is_date:
+        return None
+
+    low = coil.min if coil.min is not None else 0
+    high = coil.max if coil.max is not None else 100
+    return round(random.uniform(low, high) * coil.factor) / coil.factor
+
+
+def percentiles(samples: list[float]) -> str:
+    if len(samples) < 2:
+        return "n/a"
+    cuts = statistics.quantiles(samples, n=100)
+    return " ".join(f"p{p}={cuts[p - 1] * 1e6:.0f}us" for p in (50, 90, 99)) + f" max={max(samples) * 1e6:.0f}us"
+
+
+async def create_service(model: str = "F1255", latency: float = 0.0, bus_slots: int = 1, mqtt: dict | None = None) -> Service:
+    conf = schema({"mqtt": {"host": "127.0.0.1", **(mqtt or {})}, "nibe": {"nibegw": {"ip": "127.0.0.1"}, "model": model, "bus": {"concurrency": bus_slots}}})
+    service = Service(conf)
+    await service.heatpump.initialize()
+
+    service.connection = SimulatedConnection(service.heatpump, latency, bus_slots)
+    service.mqtt_client._client = InMemoryClient()
+    service.mqtt_client._loop = asyncio.get_running_loop()
+    service.mqtt_client._connected = True
+    return service
+
+
+def numeric_coils(service: Service, count: int) -> list[Coil]:
+    return numeric_coils_of(service.heatpump.get_coils(), count)
+
+
+def mapped_coils(service: Service, count: int) -> list[Coil]:
+    return [coil for coil in service.heatpump.get_coils() if coil.has_mappings][:count]
+
+
+def numeric_coils_of(coils: list[Coil], count: int) -> list[Coil]:
+    return [coil for coil in coils if not coil.is_date and coil.size in ("s8", "u8", "s16", "u16")][:count]
+
+
+async def bench_update_throughput(updates: int, coils: int) -> dict:
+    """Push updates as fast as possible and measure update -> publish cost."""
+    service = await create_service()
+    client = service.mqtt_client._client
+    samples = [CoilData(coil, random_value(coil)) for coil in numeric_coils(service, coils)]
+
+    latencies = []
+    start = time.perf_counter()
+    for coil_data in itertools.islice(itertools.cycle(samples), updates):
+        pushed = time.perf_counter()
+        service.heatpump.notify_coil_update(coil_data)
+        latencies.append(client.published[-1][0] - pushed)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "updates": updates,
+        "publishes": len(client.published),
+        "updates_per_second": updates / elapsed,
+        "latency": percentiles(latencies),
+    }
+
+
+async def bench_update_rate(rate: float, duration: float, coils: int) -> dict:
+    """Push updates at a fixed rate from the event loop, as NibeGW does, and measure publish latency."""
+    service = await create_service()
+    client = service.mqtt_client._client
+    samples = itertools.cycle([CoilData(coil, random_value(coil)) for coil in numeric_coils(service, coils)])
+
+    latencies = []
+    next_push = time.perf_counter()
+    deadline = next_push + duration
+    while next_push < deadline:
+        await asyncio.sleep(max(0.0, next_push - time.perf_counter()))
+        pushed = time.perf_counter()
+        service.heatpump.notify_coil_update(next(samples))
+        latencies.append(client.published[-1][0] - pushed)
+        next_push += 1 / rate
+
+    return {"rate": rate, "updates": len(latencies), "latency": percentiles(latencies)}
+
+
+async def bench_publish_path(updates: int, coils: int) -> dict:
+    """Per-call cost of the coil update and MQTT command paths through a real paho client with the socket stubbed."""
+    unlimited = {"rate": 1e9, "burst": 10**9, "coil_rate": 1e9, "coil_burst": 10**9}
+    service = await create_service(mqtt={"commands": unlimited})
+    client = MqttConnection(None, service.mqtt_client._conf)._client
+    client._send_publish = lambda *args: 0
+    service.mqtt_client._client = client
+    service.mqtt_client._asyncio = True  # dispatch commands inline
+    service.handle_coil_set = lambda name, value: None
+    samples = [CoilData(coil, random_value(coil)) for coil in numeric_coils(service, coils) + mapped_coils(service, coils)]
+    messages = [SimpleNamespace(topic=f"nibe/coils/{coil_data.coil.name}/set", payload=b"1", retain=False) for coil_data in samples]
+
+    start = time.perf_counter()
+    for coil_data in itertools.islice(itertools.cycle(samples), updates):
+        service.on_coil_update(coil_data)
+    update_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for message in itertools.islice(itertools.cycle(messages), updates):
+        service.mqtt_client._on_message_cb(client, None, message)
+    command_seconds = time.perf_counter() - start
+
+    return {"updates": updates, "update_us": update_seconds / updates * 1e6, "command_us": command_seconds / updates * 1e6}
+
+
+async def bench_aggregate(rate: float, duration: float, coils: int, per_coil: bool) -> dict:
+    """Push updates at a fixed rate with aggregated state topics and count resulting MQTT messages."""
+    service = await create_service(mqtt={"aggregate": {"window": 0.5, "per_coil": per_coil}})
+    client = service.mqtt_client._client
+    samples = itertools.cycle([CoilData(coil, random_value(coil)) for coil in numeric_coils(service, coils)])
+
+    updates = 0
+    next_push = time.perf_counter()
+    deadline = next_push + duration
+    while next_push < deadline:
+        await asyncio.sleep(max(0.0, next_push - time.perf_counter()))
+        service.heatpump.notify_coil_update(next(samples))
+        updates += 1
+        next_push += 1 / rate
+    service.mqtt_client.stop()
+
+    state = [(topic, payload) for _, topic, payload in client.published if topic.startswith("nibe/")]
+    return {"per_coil": per_coil, "updates": updates, "messages": len(state), "bytes": sum(len(topic) + len(str(payload)) for topic, payload in state)}
+
+
+async def bench_poll_sweep(coils: int, latency: float, bus_slots: int, batch: bool, concurrency: int) -> dict:
+    """Time a full poll sweep over the given number of stale coils."""
+    service = await create_service(latency=latency, bus_slots=bus_slots)
+    poll_coils = [coil.address for coil in numeric_coils(service, coils)]
+    with mock.patch.object(PollService, "STARTUP_DELAY", 0):
+        service.poller.add_service(service, {"interval": 60, "batch": batch, "concurrency": concurrency, "coils": poll_coils})
+    poller = service.poller
+
+    start = time.perf_counter()
+    await poller._poll_due()
+    elapsed = time.perf_counter() - start
+
+    return {"coils": len(poll_coils), "batch": batch, "reads": service.connection.reads, "sweep_seconds": elapsed}
+
+
+async def bench_startup(model: str, lazy: bool, coils: int) -> dict:
+    """Time heat pump initialization and lookup of the polled coils, and measure memory held by the coil table."""
+    heatpump = (LazyHeatPump if lazy else HeatPump)(getattr(Model, model))
+    addresses = [coil.address for coil in numeric_coils_of(await _eager_coils(model), coils)]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    await heatpump.initialize()
+    for address in addresses:
+        heatpump.get_coil_by_address(address)
+    elapsed = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"model": model, "lazy": lazy, "startup_ms": elapsed * 1000, "retained_kib": retained / 1024, "peak_kib": peak / 1024}
+
+
+async def _eager_coils(model: str) -> list[Coil]:
+    heatpump = HeatPump(getattr(Model, model))
+    await heatpump.initialize()
+    return heatpump.get_coils()
+
+
+async def bench_write_during_sweep(coils: int, latency: float) -> dict:
+    """Measure how long a user write waits while a poll sweep keeps the bus busy."""
+    service = await create_service(latency=latency)
+    poll_coils = [coil.address for coil in numeric_coils(service, coils)]
+    with mock.patch.object(PollService, "STARTUP_DELAY", 0):
+        service.poller.add_service(service, {"interval": 60, "batch": True, "concurrency": 4, "coils": poll_coils})
+
+    sweep = asyncio.create_task(service.poller._poll_due())
+    await asyncio.sleep(latency * 2.5)
+    coil = service.heatpump.get_coil_by_address(poll_coils[-1])
+    start = time.perf_counter()
+    await service.write_coil(CoilData(coil, random_value(coil)))
+    write_seconds = time.perf_counter() - start
+    await sweep
+
+    return {"coils": len(poll_coils), "write_wait_seconds": write_seconds, "reads": service.connection.reads}
+
+
+async def bench_memory(updates: int, coils: int) -> dict:
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    await bench_update_throughput(updates, coils)
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    growth = sum(stat.size_diff for stat in snapshot.compare_to(baseline, "filename"))
+    return {"peak_kib": peak / 1024, "retained_kib": growth / 1024}
+
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    return {
+        "update_throughput": await bench_update_throughput(args.updates, args.coils),
+        "publish_path": await bench_publish_path(args.updates, args.coils),
+        "update_rate": await bench_update_rate(args.rate, args.duration, args.coils),
+        "aggregate_per_coil": await bench_aggregate(args.rate, args.duration, args.coils, per_coil=True),
+        "aggregate_only": await bench_aggregate(args.rate, args.duration, args.coils, per_coil=False),
+        "poll_sweep": await bench_poll_sweep(args.coils, args.latency, args.bus_slots, batch=False, concurrency=1),
+        "poll_sweep_batch": await bench_poll_sweep(args.coils, args.latency, args.bus_slots, batch=True, concurrency=args.concurrency),
+        "write_during_sweep": await bench_write_during_sweep(args.coils, args.latency),
+        "memory": await bench_memory(args.updates, args.coils),
+        "startup": await bench_startup(args.model, lazy=False, coils=args.coils),
+        "startup_lazy": await bench_startup(args.model, lazy=True, coils=args.coils),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=20000, help="number of coil updates to push")
+    parser.add_argument("--coils", type=int, default=300, help="number of distinct coils")
+    parser.add_argument("--rate", type=float, default=500, help="updates per second for the paced run")
+    parser.add_argument("--duration", type=float, default=2.0, help="seconds for the paced run")
+    parser.add_argument("--latency", type=float, default=0.005, help="simulated bus latency per read in seconds")
+    parser.add_argument("--bus-slots", type=int, default=1, help="requests the simulated pump serves at the same time")
+    parser.add_argument("--concurrency", type=int, default=4, help="poll concurrency for the batched sweep")
+    parser.add_argument("--model", default="F1255", help="heat pump model for the startup run")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    for name, result in asyncio.run(run(args)).items():
+        print(f"{name:20} " + " ".join(f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
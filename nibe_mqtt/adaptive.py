@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+_UNSET = object()
+
+
+class AdaptiveInterval:
+    """Poll interval of a single coil learned from its updates.
+
+    Polls of an unchanged value back the interval off exponentially up to `max_interval`, a changed value snaps it
+    back to the configured interval. While the pump pushes the coil on its own, polling only acts as a watchdog that
+    fires once pushes stay away for `PUSH_MARGIN` push periods."""
+
+    PUSH_MARGIN = 2.0
+    PUSH_SMOOTHING = 0.25
+
+    def __init__(self, interval: float, max_interval: float, backoff: float):
+        self.base = interval
+        self.max_interval = max(interval, max_interval)
+        self.backoff = backoff
+
+        self.interval = interval
+        self.push_period: float | None = None
+        self._last_push: float | None = None
+        self._value = _UNSET
+
+    def update(self, value, now: float, pushed: bool):
+        if pushed:
+            if self._last_push is not None:
+                period = now - self._last_push
+                self.push_period = period if self.push_period is None else self.push_period + self.PUSH_SMOOTHING * (period - self.push_period)
+            self._last_push = now
+
+        if self._value is not _UNSET and value != self._value:
+            self.interval = self.base
+        elif not pushed and self._value is not _UNSET:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        self._value = value
+
+    def is_push_covered(self, now: float) -> bool:
+        return self.push_period is not None and now - self._last_push <= self.PUSH_MARGIN * self.push_period
+
+    def next_poll(self, now: float) -> float:
+        """Seconds from `now` until the coil should be polled."""
+        if self.is_push_covered(now):
+            return max(self.interval, self._last_push + self.PUSH_MARGIN * self.push_period - now)
+
+        return self.interval
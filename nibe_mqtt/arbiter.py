@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections.abc import Awaitable
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Callable
+
+from nibe.coil import Coil
+
+from nibe_mqtt.metrics import registry
+
+duplicate_reads = registry.counter("nibe_mqtt_bus_duplicate_reads_total", "Coil reads joined to a read of the same coil already pending")
+
+
+class Priority(IntEnum):
+    WRITE = 0
+    READBACK = 1
+    POLL = 2
+
+
+wait_seconds = {
+    priority: registry.histogram(f"nibe_mqtt_bus_wait_{priority.name.lower()}_seconds", f"Time {priority.name.lower()} requests waited for the bus")
+    for priority in Priority
+}
+
+
+class _Ticket:
+    def __init__(self, priority: Priority):
+        self.priority = priority
+        self.future: asyncio.Future | None = None
+
+
+class BusArbiter:
+    """Single gate for all requests to a heat pump connection.
+
+    At most `concurrency` requests run at a time and starts are spaced to `rate` requests per second. Waiting
+    requests are served by priority: user writes, then their read-backs, then background polls. A read of a coil
+    that is already pending joins it instead of going to the bus again."""
+
+    def __init__(self, concurrency: int = 1, rate: float = 0):
+        self._concurrency = concurrency
+        self._spacing = 1 / rate if rate else 0.0
+        self._active = 0
+        self._next_start = 0.0
+        self._waiters: list[tuple[int, int, _Ticket]] = []
+        self._counter = itertools.count()
+        self._reads: dict[Coil, tuple[_Ticket, asyncio.Future]] = {}
+
+    def _push(self, ticket: _Ticket, priority: Priority):
+        # Raising priority of a queued request adds a second entry, whichever is granted first wins
+        ticket.priority = min(ticket.priority, priority)
+        heapq.heappush(self._waiters, (priority, next(self._counter), ticket))
+
+    def _grant(self):
+        while self._waiters and self._active < self._concurrency:
+            _, _, ticket = heapq.heappop(self._waiters)
+            if not ticket.future.done():
+                self._active += 1
+                ticket.future.set_result(None)
+
+    async def _acquire(self, ticket: _Ticket):
+        start = time.monotonic()
+        ticket.future = asyncio.get_running_loop().create_future()
+        self._push(ticket, ticket.priority)
+        self._grant()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self._release()  # slot was handed over just before cancellation
+            raise
+
+        if self._spacing:
+            now = time.monotonic()
+            delay = self._next_start - now
+            self._next_start = max(now, self._next_start) + self._spacing
+            if delay > 0:
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    self._release()
+                    raise
+
+        wait_seconds[ticket.priority].observe(time.monotonic() - start)
+
+    def _release(self):
+        self._active -= 1
+        self._grant()
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority):
+        await self._acquire(_Ticket(priority))
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def run(self, priority: Priority, request: Callable[..., Awaitable], *args):
+        async with self.slot(priority):
+            return await request(*args)
+
+    async def read(self, coil: Coil, read_coil: Callable[[Coil], Awaitable], priority: Priority):
+        pending = self._reads.get(coil)
+        if pending is not None:
+            ticket, task = pending
+            duplicate_reads.inc()
+            if priority < ticket.priority:
+                if ticket.future is None:
+                    ticket.priority = priority
+                elif not ticket.future.done():
+                    self._push(ticket, priority)
+            return await asyncio.shield(task)
+
+        ticket = _Ticket(priority)
+        task = asyncio.ensure_future(self._read(ticket, coil, read_coil))
+        self._reads[coil] = (ticket, task)
+        task.add_done_callback(lambda _: self._read_done(coil, task))
+        return await asyncio.shield(task)
+
+    def _read_done(self, coil: Coil, task: asyncio.Future):
+        if self._reads.get(coil, (None, None))[1] is task:
+            del self._reads[coil]
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every caller was cancelled meanwhile
+
+    async def _read(self, ticket: _Ticket, coil: Coil, read_coil: Callable[[Coil], Awaitable]):
+        await self._acquire(ticket)
+        try:
+            return await read_coil(coil)
+        finally:
+            self._release()
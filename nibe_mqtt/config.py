@@ -1,17 +1,19 @@
 from __future__ import annotations
 
+import hashlib
 import ipaddress
+import json
+import logging
+import os
 from pathlib import Path
 
-import yaml
-from nibe.heatpump import Model
-from paho.mqtt.client import MQTTv5, MQTTv31, MQTTv311
 from voluptuous import (
     All,
     Any,
     Exclusive,
     Inclusive,
     InInvalid,
+    Length,
     Optional,
     Range,
     Required,
@@ -19,11 +21,30 @@ from voluptuous import (
     ValueInvalid,
 )
 
-mqtt_protocol_map = {"3.1": MQTTv31, "3.1.1": MQTTv311, "5": MQTTv5}
+logger = logging.getLogger("nibe").getChild(__name__)
+
+# Protocol versions as defined by paho.mqtt.client, kept here to avoid importing paho before it is needed
+mqtt_protocol_map = {"3.1": 3, "3.1.1": 4, "5": 5}
 
 
 port = All(int, Range(min=1024, max=65535))
 
+poll_interval = All(int, Range(min=5, max=60 * 60 * 24))
+
+deadband = All(Any(int, float), Range(min=0))
+
+
+def statistics_windows(windows: list):
+    shortest = min(windows)
+    if any(window % shortest for window in windows):
+        raise ValueInvalid(f"statistics windows must be multiples of the shortest one: {windows}")
+    return windows
+
+
+def str_keys(mapping: dict) -> dict:
+    """Coil overrides keyed by name or address, addresses as strings so the mapping survives a JSON round-trip."""
+    return {str(key): value for key, value in mapping.items()}
+
 
 def ip_address(v):
     try:
@@ -34,6 +55,8 @@ def ip_address(v):
 
 
 def heatpump_model(key: str):
+    from nibe.heatpump import Model
+
     try:
         return getattr(Model, key)
     except AttributeError:
@@ -60,16 +83,61 @@ nibe_schema = Schema(
             Required("url"): str,
             Required("slave_id"): int,
             Optional("options", default=None): Any(None, dict),
+            Optional("max_gap", default=0): All(int, Range(min=0, max=124)),
+            Optional("max_block_length", default=125): All(int, Range(min=1, max=125)),
         },
         Required("model"): heatpump_model,
+        Optional("prefix"): str,
         Optional("word_swap", default=None): Any(None, bool),
+        Optional("lazy_coils", default=False): bool,
+        Optional("bus", default={}): {
+            Optional("concurrency", default=1): All(int, Range(min=1, max=8)),
+            Optional("rate", default=0): All(Any(int, float), Range(min=0)),
+        },
+        Optional("write", default={}): {
+            Optional("concurrency", default=1): All(int, Range(min=1, max=8)),
+            Optional("readback_delay", default=0.5): All(Any(int, float), Range(min=0, max=60)),
+        },
+        Optional("snapshot"): {
+            Required("path"): str,
+            Optional("interval", default=30): All(int, Range(min=1)),
+        },
+        Optional("history"): {
+            Required("path"): str,
+            Optional("flush_interval", default=60): All(int, Range(min=1)),
+            Optional("keep_days"): All(int, Range(min=1)),
+        },
         Optional("poll"): {
-            Optional("interval", default=60): All(int, Range(min=5, max=60 * 60 * 24)),
-            Optional("coils"): [str, int],
+            Optional("interval", default=60): poll_interval,
+            Optional("batch", default=False): bool,
+            # Parallel batched reads, defaults to bus.concurrency which caps them anyway
+            Optional("concurrency"): All(int, Range(min=1, max=32)),
+            Optional("adaptive"): {
+                Optional("max_interval", default=3600): poll_interval,
+                Optional("backoff", default=2.0): All(Any(int, float), Range(min=1, max=10)),
+            },
+            Optional("coils"): [
+                str,
+                int,
+                {
+                    Required("coil"): Any(str, int),
+                    Optional("interval"): poll_interval,
+                },
+            ],
         },
     }
 )
 
+
+def unique_prefixes(heatpumps: list):
+    prefixes = [heatpump.get("prefix") for heatpump in heatpumps]
+    if None in prefixes:
+        raise ValueInvalid("prefix is required for every heat pump when several are configured")
+    if len(set(prefixes)) != len(prefixes):
+        raise ValueInvalid(f"heat pump prefixes must be unique: {prefixes}")
+    return heatpumps
+
+
 schema = Schema(
     {
         Required("mqtt"): {
@@ -80,10 +148,69 @@ schema = Schema(
             Inclusive("username", "auth"): str,
             Inclusive("password", "auth"): str,
             Optional("protocol", default="3.1.1"): mqtt_protocol,
+            Optional("network_loop", default="thread"): Any("thread", "asyncio"),
             Optional("retain_state", default=True): bool,
             Optional("retain_availability", default=True): bool,
+            Optional("outbox", default={}): {
+                Optional("max_size", default=1000): All(int, Range(min=1)),
+                Optional("flush_rate", default=100): All(Any(int, float), Range(min=1)),
+                Optional("spool"): str,
+            },
+            Optional("commands", default={}): {
+                Optional("rate", default=10): All(Any(int, float), Range(min=0.1)),
+                Optional("burst", default=20): All(int, Range(min=1)),
+                Optional("coil_rate", default=1): All(Any(int, float), Range(min=0.01)),
+                Optional("coil_burst", default=5): All(int, Range(min=1)),
+                Optional("max_payload", default=64): All(int, Range(min=1)),
+            },
+            Optional("aggregate"): {
+                Optional("window", default=1.0): All(Any(int, float), Range(min=0.05, max=60)),
+                Optional("per_coil", default=False): bool,
+            },
+            Optional("announce"): {
+                Optional("coils", default="poll"): Any("poll", "all"),
+                Optional("rate", default=20): All(Any(int, float), Range(min=1)),
+                Optional("diff", default=True): bool,
+            },
+            Optional("statistics"): {
+                Optional("windows", default=[60, 900]): All([All(int, Range(min=10, max=86400))], Length(min=1), statistics_windows),
+                Required("coils"): [
+                    str,
+                    int,
+                    {
+                        Required("coil"): Any(str, int),
+                        Optional("raw", default=True): bool,
+                    },
+                ],
+            },
+            Optional("state_filter"): {
+                Optional("heartbeat", default=300): All(int, Range(min=0)),
+                Optional("absolute", default=0): deadband,
+                Optional("relative", default=0): deadband,
+                Optional("coils", default={}): All(
+                    {
+                        Any(str, int): {
+                            Optional("heartbeat"): All(int, Range(min=0)),
+                            Optional("absolute"): deadband,
+                            Optional("relative"): deadband,
+                        }
+                    },
+                    str_keys,
+                ),
+            },
+        },
+        Required("nibe"): Any(nibe_schema, All([nibe_schema], Length(min=1), unique_prefixes)),
+        Optional("metrics"): {
+            Optional("http_host", default="0.0.0.0"): ip_address,
+            Optional("http_port"): port,
+            Optional("mqtt_interval", default=60): All(int, Range(min=0)),
+        },
+        Optional("watchdog"): {
+            Optional("threshold", default=0.1): All(Any(int, float), Range(min=0.01)),
+            Optional("sample_interval", default=0.005): All(Any(int, float), Range(min=0.001, max=1)),
+            Optional("profile_dir", default="."): str,
+            Optional("profile_seconds", default=30): All(Any(int, float), Range(min=1, max=3600)),
         },
-        Required("nibe"): nibe_schema,
         Optional("logging", default={}): {
             Optional("level", default="INFO"): str,
             Optional("format", default="%(asctime)s - %(levelname)-8s - %(message)s"): str,
@@ -92,17 +219,104 @@ schema = Schema(
 )
 
 
+def changed_keys(old: dict, new: dict) -> set[str]:
+    """Settings that differ between two validated configs, as `block` or `block.key` for `mqtt` and `nibe`.
+
+    A changed number of heat pumps is reported as `nibe`."""
+    changed = set()
+    for block in old.keys() | new.keys():
+        old_block, new_block = old.get(block), new.get(block)
+        if block == "mqtt":
+            changed |= {f"mqtt.{key}" for key in old_block.keys() | new_block.keys() if old_block.get(key) != new_block.get(key)}
+        elif block == "nibe":
+            old_list = old_block if isinstance(old_block, list) else [old_block]
+            new_list = new_block if isinstance(new_block, list) else [new_block]
+            if len(old_list) != len(new_list):
+                changed.add("nibe")
+                continue
+            for old_nibe, new_nibe in zip(old_list, new_list):
+                changed |= {f"nibe.{key}" for key in old_nibe.keys() | new_nibe.keys() if old_nibe.get(key) != new_nibe.get(key)}
+        elif old_block != new_block:
+            changed.add(block)
+
+    return changed
+
+
 class Config:
     def __init__(self):
         self._data = None
 
-    def load(self, config_file: Path) -> dict:
+    def load(self, config_file: Path, cache: bool = True) -> dict:
+        """Load and validate the configuration.
+
+        Validated config is cached as JSON next to the config file and reused while the file, the schema and the
+        nibe library are unchanged."""
         assert config_file.is_file(), f"{config_file} should be a file"
-        with config_file.open("r", encoding="utf-8") as fh:
-            self._data = schema(yaml.safe_load(fh))
+        content = config_file.read_bytes()
+
+        cache_file = config_file.with_name(f".{config_file.name}.cache")
+        key = self._cache_key(content)
+        if cache:
+            self._data = self._read_cache(cache_file, key)
+            if self._data is not None:
+                return self._data
+
+        import yaml
+
+        self._data = schema(yaml.safe_load(content))
+
+        if cache:
+            self._write_cache(cache_file, key, self._data)
 
         return self._data
 
+    @staticmethod
+    def _cache_key(content: bytes) -> str:
+        import nibe
+
+        from nibe_mqtt import __version__
+
+        # Schema source covers changes of defaults in development installs that keep the version
+        schema_source = Path(__file__).read_bytes()
+        return hashlib.sha256(b"\0".join((__version__.encode(), nibe.__version__.encode(), schema_source, content))).hexdigest()
+
+    @staticmethod
+    def _read_cache(cache_file: Path, key: str) -> dict | None:
+        try:
+            with cache_file.open("r", encoding="utf-8") as fh:
+                cached = json.load(fh)
+            if cached["key"] != key:
+                return None
+
+            data = cached["data"]
+            # Heat pump model is the only validated value that is not plain JSON, it is stored by name
+            for nibe_conf in data["nibe"] if isinstance(data["nibe"], list) else [data["nibe"]]:
+                nibe_conf["model"] = heatpump_model(nibe_conf["model"])
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.debug(f"Ignoring config cache {cache_file}: {e}")
+            return None
+
+        return data
+
+    @staticmethod
+    def _write_cache(cache_file: Path, key: str, data: dict):
+        from nibe.heatpump import Model
+
+        def model_name(value):
+            if isinstance(value, Model):
+                return value.name
+            raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+        try:
+            content = json.dumps({"key": key, "data": data}, default=model_name)
+            tmp = cache_file.with_suffix(cache_file.suffix + ".tmp")
+            tmp.write_text(content, encoding="utf-8")
+            os.replace(tmp, cache_file)
+        except (OSError, TypeError) as e:
+            logger.debug(f"Failed to write config cache {cache_file}: {e}")
+
     def get(self):
         assert self._data is not None, "Not yet loaded"
 
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from nibe_mqtt import cfg
+
+
+def _timestamp(value: str) -> float:
+    """ISO 8601 date or time, local time unless an offset is given."""
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def _select_heatpump(conf: dict, prefix: str | None) -> tuple[dict, str]:
+    heatpumps = conf["nibe"] if isinstance(conf["nibe"], list) else [conf["nibe"]]
+    for nibe_conf in heatpumps:
+        heatpump_prefix = nibe_conf.get("prefix") or conf["mqtt"]["prefix"]
+        if "history" in nibe_conf and prefix in (None, heatpump_prefix):
+            return nibe_conf, heatpump_prefix
+
+    raise SystemExit(f"No heat pump with history configured{f' for prefix {prefix}' if prefix else ''}")
+
+
+def _load_coils(nibe_conf: dict):
+    from nibe_mqtt.heatpump import LazyHeatPump
+
+    heatpump = LazyHeatPump(nibe_conf["model"])
+    asyncio.run(heatpump.initialize())
+    return heatpump
+
+
+def _samples(args, nibe_conf: dict):
+    """Yield (timestamp, coil or None, address, value) for the selected time range and coils."""
+    from nibe.exceptions import CoilNotFoundException
+
+    from nibe_mqtt.history import decode_value, read_samples
+
+    heatpump = _load_coils(nibe_conf)
+    coils = {}
+
+    def coil_of(address: int):
+        if address not in coils:
+            try:
+                coils[address] = heatpump.get_coil_by_address(address)
+            except CoilNotFoundException:
+                coils[address] = None
+        return coils[address]
+
+    wanted = None
+    if args.coil:
+        wanted = {coil.address for coil in (heatpump.get_coil_by_address(int(c)) if c.isdigit() else heatpump.get_coil_by_name(c) for c in args.coil)}
+
+    for timestamp, address, value in read_samples(Path(nibe_conf["history"]["path"]), args.start, args.end):
+        if wanted is None or address in wanted:
+            coil = coil_of(address)
+            yield timestamp, coil, address, decode_value(coil, value)
+
+
+def export(args, conf: dict) -> int:
+    nibe_conf, _ = _select_heatpump(conf, args.prefix)
+    out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        writer = csv.writer(out)
+        writer.writerow(["time", "address", "name", "value"])
+        for timestamp, coil, address, value in _samples(args, nibe_conf):
+            iso = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat(timespec="milliseconds")
+            writer.writerow([iso, address, coil.name if coil is not None else "", value])
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    return 0
+
+
+def replay(args, conf: dict) -> int:
+    from paho.mqtt.client import CallbackAPIVersion, Client
+
+    nibe_conf, prefix = _select_heatpump(conf, args.prefix)
+    topic = args.topic or f"{prefix}/history"
+    mqtt_conf = conf["mqtt"]
+
+    client = Client(CallbackAPIVersion.VERSION1, "nibe-history-" + os.urandom(4).hex(), protocol=mqtt_conf["protocol"])
+    if mqtt_conf.get("username"):
+        client.username_pw_set(username=mqtt_conf["username"], password=mqtt_conf["password"])
+    client.connect(host=mqtt_conf["host"], port=mqtt_conf["port"])
+    client.loop_start()
+
+    count = 0
+    info = None
+    delay = 1 / args.rate if args.rate else 0
+    try:
+        for timestamp, coil, address, value in _samples(args, nibe_conf):
+            name = coil.name if coil is not None else str(address)
+            info = client.publish(f"{topic}/coils/{name}", json.dumps({"time": timestamp, "value": value}), qos=1)
+            count += 1
+            if delay:
+                time.sleep(delay)
+        if info is not None:
+            info.wait_for_publish()
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+    print(f"Replayed {count} samples to {topic}/coils/#")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or replay coil history recorded by nibe-mqtt")
+    parser.add_argument("-c", "--config", type=str, default="config.yaml", help="specify path to a configuration file")
+    parser.add_argument("--prefix", help="heat pump to use when several are configured, by its MQTT prefix")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    now = time.time()
+    for name, description in (("export", "write samples as CSV"), ("replay", "publish samples to MQTT")):
+        sub = subparsers.add_parser(name, help=description)
+        sub.add_argument("--start", type=_timestamp, default=now - 86400, help="ISO 8601 start time, default 24 hours ago")
+        sub.add_argument("--end", type=_timestamp, default=now, help="ISO 8601 end time, default now")
+        sub.add_argument("--coil", action="append", help="coil name or address, can be repeated, default all coils")
+
+    subparsers.choices["export"].add_argument("-o", "--output", help="CSV file, default stdout")
+    subparsers.choices["replay"].add_argument("--topic", help="topic prefix to publish under, default <prefix>/history")
+    subparsers.choices["replay"].add_argument("--rate", type=float, default=100, help="messages per second, 0 for unlimited")
+    args = parser.parse_args(argv)
+
+    conf = cfg.load(Path(args.config))
+    sys.exit(export(args, conf) if args.command == "export" else replay(args, conf))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,24 +4,50 @@ from __future__ import annotations
 import argparse
 import asyncio
 import sys
+from pathlib import Path
 
 from nibe import __version__ as nibe_lib_version
 
 from nibe_mqtt import __version__ as nibe_mqtt_version
-from nibe_mqtt.service import run_service
+from nibe_mqtt import cfg
 
 if sys.version_info < (3, 9):
     print(f"You are using Python {sys.version_info[0]}.{sys.version_info[1]}, but Nibe daemon requires at least Python 3.9")
     sys.exit(-1)
 
 
+def check_config(config_path: str) -> int:
+    """Validate the configuration file without connecting to the heat pump or the broker."""
+    from voluptuous import Invalid
+
+    try:
+        conf = cfg.load(Path(config_path), cache=False)
+    except (AssertionError, OSError, Invalid) as e:
+        print(f"{config_path}: invalid configuration: {e}")
+        return 1
+    except Exception as e:
+        print(f"{config_path}: failed to parse configuration: {e}")
+        return 1
+
+    heatpumps = conf["nibe"] if isinstance(conf["nibe"], list) else [conf["nibe"]]
+    print(f"{config_path}: configuration OK, {len(heatpumps)} heat pump(s): {', '.join(heatpump['model'].name for heatpump in heatpumps)}")
+    return 0
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--config", type=str, default="config.yaml", help="specify path to a configuration file")
+    parser.add_argument("--check-config", action="store_true", help="validate the configuration file and exit")
+    parser.add_argument("--watch-config", type=float, default=0, metavar="SECONDS", help="reload the configuration file when it changes, checked every SECONDS")
     args = parser.parse_args()
 
+    if args.check_config:
+        sys.exit(check_config(args.config))
+
+    from nibe_mqtt.service import run_service
+
     version_msg = f"Running Nibe MQTT {nibe_mqtt_version} service with Nibe {nibe_lib_version} lib"
-    asyncio.run(run_service(args.config, log_version=version_msg))
+    asyncio.run(run_service(args.config, log_version=version_msg, watch_config=args.watch_config))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+from __future__ import annotations
+
+import time
+
+from nibe.coil import Coil, CoilData
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class StateFilter:
+    """Suppresses coil state publishes that carry no new information.
+
+    A value is published when it moved outside the deadband around the last published value
+    or when the last publish is older than the heartbeat. Heartbeat 0 never republishes unchanged values."""
+
+    def __init__(self, conf: dict):
+        self._conf = conf
+        self._coil_conf: dict[Coil, dict] = {}
+        self._published: dict[Coil, tuple[object, float]] = {}
+
+    def _get_coil_conf(self, coil: Coil) -> dict:
+        conf = self._coil_conf.get(coil)
+        if conf is None:
+            overrides = self._conf["coils"].get(coil.name, self._conf["coils"].get(str(coil.address), {}))
+            conf = {
+                "heartbeat": self._conf["heartbeat"],
+                "absolute": self._conf["absolute"],
+                "relative": self._conf["relative"],
+                **overrides,
+            }
+            self._coil_conf[coil] = conf
+
+        return conf
+
+    def should_publish(self, coil_data: CoilData) -> bool:
+        coil = coil_data.coil
+        conf = self._get_coil_conf(coil)
+        now = time.monotonic()
+
+        last = self._published.get(coil)
+        if last is not None:
+            last_value, last_time = last
+            heartbeat = conf["heartbeat"]
+            if not self._is_changed(conf, last_value, coil_data.value) and (not heartbeat or now - last_time < heartbeat):
+                return False
+
+        self._published[coil] = (coil_data.value, now)
+        return True
+
+    @staticmethod
+    def _is_changed(conf: dict, last_value, value) -> bool:
+        if _is_number(value) and _is_number(last_value):
+            return abs(value - last_value) > max(conf["absolute"], conf["relative"] * abs(last_value))
+
+        return value != last_value
+
+    def clear(self):
+        self._published.clear()
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+
+from nibe.coil import Coil
+from nibe.heatpump import HeatPump, Model
+
+logger = logging.getLogger("nibe").getChild(__name__)
+
+
+class LazyHeatPump(HeatPump):
+    """Heat pump creating coil objects on first lookup.
+
+    Startup only builds a name to address index, coil definitions stay as loaded from the model data until a coil
+    is polled, pushed by the pump or written over MQTT."""
+
+    def __init__(self, model: Model | None = None):
+        super().__init__(model)
+
+        self._coil_data: dict[str, dict] = {}
+        self._addresses: list[str] = []
+        self._name_to_address: dict[str, str] = {}
+
+    async def _load_coils(self):
+        assert self._model is not None, "Model is not set"
+        data = await asyncio.get_running_loop().run_in_executor(None, self._model.get_coil_data)
+
+        self._coil_data = data
+        self._addresses = list(data)
+        self._name_to_address = {definition.get("name"): address for address, definition in data.items()}
+        self._address_to_coil = {}
+        self._name_to_coil = {}
+
+    def _build_coil(self, address: str):
+        definition = self._coil_data.pop(address, None)
+        if definition is None:
+            return
+
+        try:
+            coil = Coil(address=int(address), **definition)
+        except (AssertionError, TypeError) as e:
+            logger.warning(f"Failed to register coil {address}: {e}")
+            return
+
+        self._address_to_coil[address] = coil
+        self._name_to_coil[coil.name] = coil
+
+    def get_coils(self) -> list[Coil]:
+        for address in list(self._coil_data):
+            self._build_coil(address)
+
+        return [self._address_to_coil[address] for address in self._addresses if address in self._address_to_coil]
+
+    def get_coil_by_address(self, address: int | str) -> Coil:
+        self._build_coil(str(address))
+        return super().get_coil_by_address(address)
+
+    def get_coil_by_name(self, name: str) -> Coil:
+        if name not in self._name_to_coil and name in self._name_to_address:
+            self._build_coil(self._name_to_address[name])
+        return super().get_coil_by_name(name)
+
+    def get_writable_coil_names(self) -> frozenset[str]:
+        """Names of writable coils, without building the coils that are not loaded yet."""
+        names = {definition["name"] for definition in self._coil_data.values() if definition.get("write")}
+        return frozenset(names.union(coil.name for coil in self._name_to_coil.values() if coil.is_writable))
+
+    @property
+    def loaded_coils(self) -> int:
+        return len(self._address_to_coil)
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import datetime
+import logging
+import struct
+import sys
+import time
+import zlib
+from array import array
+from collections.abc import Iterator
+from pathlib import Path
+
+from nibe.coil import Coil
+from nibe.exceptions import NoMappingException
+
+logger = logging.getLogger("nibe").getChild(__name__)
+
+MAGIC = b"NBH1"
+SUFFIX = ".nbh"
+# magic, sample count, base timestamp, compressed length
+CHUNK_HEADER = struct.Struct("<4sIdI")
+DAY = 86400
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def _to_bytes(column: array) -> bytes:
+    if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _from_bytes(typecode: str, data: bytes) -> array:
+    column = array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def _day_of(path: Path) -> datetime.date | None:
+    try:
+        return datetime.date.fromisoformat(path.stem)
+    except ValueError:
+        return None
+
+
+def encode_chunk(times: array, addresses: array, values: array) -> bytes:
+    """Encode samples of one day as a chunk of compressed columns: millisecond offsets, addresses and values."""
+    base = times[0]
+    offsets = array("i", (round((t - base) * 1000) for t in times))
+    body = zlib.compress(_to_bytes(offsets) + _to_bytes(addresses) + _to_bytes(values))
+    return CHUNK_HEADER.pack(MAGIC, len(times), base, len(body)) + body
+
+
+def read_file(path: Path) -> Iterator[tuple[float, int, float]]:
+    """Yield (timestamp, address, value) samples of a history file. A truncated or corrupt chunk ends the file."""
+    with path.open("rb") as fh:
+        while header := fh.read(CHUNK_HEADER.size):
+            if len(header) < CHUNK_HEADER.size:
+                logger.warning(f"Truncated chunk header in {path}")
+                return
+
+            magic, count, base, length = CHUNK_HEADER.unpack(header)
+            body = fh.read(length)
+            try:
+                if magic != MAGIC or len(body) < length:
+                    raise ValueError("truncated chunk")
+                raw = zlib.decompress(body)
+            except (ValueError, zlib.error) as e:
+                logger.warning(f"Skipping rest of {path}: {e}")
+                return
+
+            addresses_start, values_start = count * 4, count * 6
+            offsets = _from_bytes("i", raw[:addresses_start])
+            addresses = _from_bytes("H", raw[addresses_start:values_start])
+            values = _from_bytes("d", raw[values_start:])
+            for offset, address, value in zip(offsets, addresses, values):
+                yield base + offset / 1000, address, value
+
+
+def read_samples(directory: Path, start: float, end: float) -> Iterator[tuple[float, int, float]]:
+    """Yield samples with `start <= timestamp < end` from the daily files in `directory`, oldest file first."""
+    first = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).date()
+    last = datetime.datetime.fromtimestamp(end, datetime.timezone.utc).date()
+    for path in sorted(directory.glob(f"*{SUFFIX}")):
+        day = _day_of(path)
+        if day is None or not first <= day <= last:
+            continue
+
+        for sample in read_file(path):
+            if start <= sample[0] < end:
+                yield sample
+
+
+def decode_value(coil: Coil | None, value: float):
+    """Turn a stored value back into what was published: mapped text or a number."""
+    if coil is not None and coil.has_mappings:
+        try:
+            return coil.get_mapping_for(int(value))
+        except NoMappingException:
+            pass
+
+    return int(value) if value.is_integer() else value
+
+
+class HistorySink:
+    """Collects coil samples in memory and appends them in batches to daily columnar files.
+
+    Files are named by UTC day. Every write appends one chunk per day: a header followed by zlib compressed columns
+    of millisecond offsets, coil addresses and values, around 5 bytes per sample for slowly changing coils. Mapped
+    values are stored as their raw number."""
+
+    def __init__(self, directory: Path, keep_days: int | None = None):
+        self.directory = directory
+        self.keep_days = keep_days
+        self._times = array("d")
+        self._addresses = array("H")
+        self._values = array("d")
+
+    def __len__(self):
+        return len(self._times)
+
+    def add(self, coil: Coil, value, now: float | None = None):
+        if isinstance(value, str):
+            try:
+                value = coil.get_reverse_mapping_for(value)
+            except NoMappingException:
+                return
+        elif not isinstance(value, (int, float)):
+            return
+
+        self._times.append(time.time() if now is None else now)
+        self._addresses.append(coil.address)
+        self._values.append(value)
+
+    def dump(self) -> tuple[array, array, array]:
+        """Hand over buffered samples for `write` and start a new batch."""
+        columns = self._times, self._addresses, self._values
+        self._times, self._addresses, self._values = array("d"), array("H"), array("d")
+        return columns
+
+    def write(self, times: array, addresses: array, values: array):
+        """Append dumped samples to the files of their days. Blocking, meant to run in a worker thread."""
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            start = 0
+            while start < len(times):
+                day = int(times[start] // DAY)
+                end = start + 1
+                while end < len(times) and int(times[end] // DAY) == day:
+                    end += 1
+
+                path = self.directory / f"{EPOCH + datetime.timedelta(days=day):%Y-%m-%d}{SUFFIX}"
+                with path.open("ab") as fh:
+                    fh.write(encode_chunk(times[start:end], addresses[start:end], values[start:end]))
+                start = end
+
+            if self.keep_days is not None:
+                self._prune()
+        except OSError as e:
+            logger.warning(f"Failed to write history to {self.directory}: {e}")
+
+    def _prune(self):
+        oldest = datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=self.keep_days)
+        for path in self.directory.glob(f"*{SUFFIX}"):
+            day = _day_of(path)
+            if day is not None and day < oldest:
+                path.unlink()
+
+    def save(self):
+        self.write(*self.dump())
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+logger = logging.getLogger("nibe").getChild(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, callback: Callable[[], float]):
+        self.name = name
+        self.description = description
+        self.callback = callback
+
+    def samples(self):
+        yield self.name, self.callback()
+
+    def snapshot(self):
+        return self.callback()
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}}', cumulative
+        yield f'{self.name}_bucket{{le="+Inf"}}', self.count
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", self.count
+
+    def snapshot(self):
+        return {"count": self.count, "sum": round(self.sum, 6), "max": round(self.max, 6)}
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._metrics.get(name) or self._register(Counter(name, description))
+
+    def histogram(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.get(name) or self._register(Histogram(name, description, buckets))
+
+    def gauge(self, name: str, description: str, callback: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, description, callback))
+
+    def render(self) -> str:
+        """Render metrics in Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(f"{name} {value}" for name, value in metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+
+registry = Registry()
+
+
+class MetricsServer:
+    """Minimal HTTP server exposing the registry at /metrics."""
+
+    def __init__(self, registry: Registry, host: str, port: int):
+        self._registry = registry
+        self._host = host
+        self._port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self._host, self._port)
+        logger.info(f"Serving metrics on http://{self._host}:{self._port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self._registry.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+
+            writer.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.debug(f"Metrics request failed: {e}")
+        finally:
+            writer.close()
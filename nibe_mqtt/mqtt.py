@@ -1,16 +1,33 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import json
 import logging
 import os
+import threading
+import time
 from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Callable
 
 from nibe.coil import Coil, CoilData
-from paho.mqtt.client import CallbackAPIVersion, Client, MQTTMessage
+from paho.mqtt.client import CallbackAPIVersion, Client, MQTTErrorCode, MQTTMessage
+
+from nibe_mqtt.metrics import registry
+from nibe_mqtt.outbox import Outbox
+from nibe_mqtt.ratelimit import TokenBucket
+from nibe_mqtt.statistics import STATISTICS
 
 logger = logging.getLogger("nibe").getChild(__name__)
 
+commands_dropped = {
+    reason: registry.counter(f"nibe_mqtt_commands_dropped_{reason}_total", f"MQTT set commands dropped as {reason.replace('_', ' ')}")
+    for reason in ("retained", "unknown_coil", "malformed", "rate_limited")
+}
+commands_coalesced = registry.counter("nibe_mqtt_commands_coalesced_total", "MQTT set commands over the per coil limit replaced by a newer one before delivery")
+publish_seconds = registry.histogram("nibe_mqtt_publish_seconds", "Time spent publishing a coil state", (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+
 
 class MqttHandler(ABC):
     @abstractmethod
@@ -23,12 +40,48 @@ class MqttHandler(ABC):
 
 
 class MqttConnection:
-    def __init__(self, handler: MqttHandler, conf: dict):
+    RETAINED_DISCOVERY_WAIT = 2.0
+    MISC_INTERVAL = 1.0
+    RECONNECT_MIN_DELAY = 1.0
+    RECONNECT_MAX_DELAY = 120.0
+    SPOOL_INTERVAL = 10.0
+
+    def __init__(self, handler: MqttHandler | None, conf: dict):
         self._conf = conf
-        self._handler = handler
+        self._handlers: dict[str, MqttHandler] = {}
+        if handler is not None:
+            self.add_handler(conf["prefix"], handler)
         self._loop = None
+        self._asyncio = conf["network_loop"] == "asyncio"
+        self._network_task = None
+        self._misc_task = None
+        self._socket_closed = None
+
+        self._connected = False
+        spool = conf["outbox"].get("spool")
+        self._outbox = Outbox(conf["outbox"]["max_size"], Path(spool) if spool else None)
+        self._flush_task = None
+        self._spool_task = None
+        registry.gauge("nibe_mqtt_outbox_depth", "Messages waiting in the outbox", lambda: len(self._outbox))
+        registry.gauge("nibe_mqtt_outbox_dropped", "Messages dropped from the full outbox", lambda: self._outbox.dropped)
 
         self._availability_topic = f"{conf['prefix']}/availability"
+        self._aggregate = conf.get("aggregate")
+        self._aggregates: dict[str, dict[str, object]] = {}
+        self._aggregate_dirty: set[str] = set()
+        self._aggregate_handle = None
+        self._discovery_cache: dict[Coil, tuple[str, bytes]] = {}
+        self._coil_topics: dict[str | None, dict[Coil, str]] = {}
+        self._set_topics: dict[str, tuple[str, str]] = {}
+        self._encoded_values: dict[str, bytes] = {}
+
+        self._commands = conf["commands"]
+        self._command_bucket = TokenBucket(self._commands["rate"], self._commands["burst"])
+        self._coil_buckets: dict[tuple[str, str], TokenBucket] = {}
+        self._held_commands: dict[tuple[str, str], str] = {}
+        self._command_lock = threading.Lock()
+        self._writable_coils: dict[str, frozenset[str]] = {}
+        self._diagnostics_commands: dict[str, Callable[[str], None]] = {}
 
         self._client = Client(
             CallbackAPIVersion.VERSION1,
@@ -53,67 +106,425 @@ class MqttConnection:
             retain=self._conf["retain_availability"],
         )
         self._client.publish(self._availability_topic, "online", retain=self._conf["retain_availability"])
-        self._client.subscribe(f"{self._conf['prefix']}/coils/+/set")
+        for prefix in self._handlers:
+            self._client.subscribe(f"{prefix}/coils/+/set")
+        for topic in self._diagnostics_commands:
+            self._client.subscribe(topic)
 
-        self._handler.on_mqtt_connected()
+        self._connected = True
+        for handler in self._handlers.values():
+            self._dispatch(handler.on_mqtt_connected)
+        self._dispatch(self._start_flush)
 
-    def _on_disconnect_cb(self, client, userdata, flags, reason_code, properties=None):
+    def _on_disconnect_cb(self, client, userdata, rc, *args):
+        # Callback API version 1 passes properties as well with MQTT 5 only
         logger.warning("MQTT disconnected")
+        self._connected = False
+
+    def add_handler(self, prefix: str, handler: MqttHandler):
+        """Route commands under `prefix` to the handler. One connection can serve several heat pumps."""
+        assert prefix not in self._handlers, f"Prefix {prefix} is already in use"
+        self._handlers[prefix] = handler
+
+    def add_diagnostics_command(self, name: str, callback: Callable[[str], None]):
+        """Call `callback` on the event loop with the payload of each `<prefix>/diagnostics/<name>/set` message."""
+        topic = f"{self._conf['prefix']}/diagnostics/{name}/set"
+        self._diagnostics_commands[topic] = callback
+
+        def on_message(client, userdata, msg: MQTTMessage):
+            if msg.retain:
+                commands_dropped["retained"].inc()
+            elif not self._command_bucket.allow():
+                commands_dropped["rate_limited"].inc()
+            elif self._loop is not None:
+                self._dispatch(callback, msg.payload.decode("utf-8", errors="replace"))
+
+        self._client.message_callback_add(topic, on_message)
+        if self._connected:
+            self._client.subscribe(topic)
+
+    def set_writable_coils(self, prefix: str, names: frozenset[str]):
+        """Commands for other coils under `prefix` are rejected before they reach the event loop."""
+        self._writable_coils[prefix] = names
 
     def _on_message_cb(self, client, userdata, msg: MQTTMessage):
-        coil_name = msg.topic.removeprefix(self._conf["prefix"]).split("/")[2]
-        value = msg.payload.decode("utf-8")
+        target = self._set_topics.get(msg.topic)
+        if target is None:
+            prefix, _, command = msg.topic.rpartition("/coils/")
+            coil_name = command.split("/")[0]
+        else:
+            prefix, coil_name = target
+
+        handler = self._handlers.get(prefix)
+        if handler is None:
+            logger.warning(f"No handler for MQTT topic {msg.topic}")
+            return
+
+        value = self._accept_command(prefix, coil_name, msg)
+        if value is None:
+            return
 
         logger.info(f"Received MQTT command set {coil_name} to {value}")
 
         if self._loop is not None:
-            self._loop.call_soon_threadsafe(self._handler.handle_coil_set, coil_name, value)
+            self._dispatch(handler.handle_coil_set, coil_name, value)
         else:
             logger.error("Event loop not set, cannot handle MQTT message")
 
+    def _accept_command(self, prefix: str, coil_name: str, msg: MQTTMessage) -> str | None:
+        """Return the command value, or None when the command is dropped. Runs in the network thread, before
+        anything is scheduled on the event loop."""
+        reason = None
+        writable = self._writable_coils.get(prefix)
+        if msg.retain:
+            reason = "retained"  # replayed by the broker on subscribe, not a command sent now
+        elif writable is not None and coil_name not in writable:
+            reason = "unknown_coil"
+        elif not 0 < len(msg.payload) <= self._commands["max_payload"]:
+            reason = "malformed"
+        else:
+            try:
+                value = msg.payload.decode("utf-8")
+            except UnicodeDecodeError:
+                reason = "malformed"
+            else:
+                key = (prefix, coil_name)
+                with self._command_lock:
+                    bucket = self._coil_buckets.get(key)
+                    if bucket is None:
+                        bucket = self._coil_buckets[key] = TokenBucket(self._commands["coil_rate"], self._commands["coil_burst"])
+                    # Per coil first, so that a flood of one coil does not use up the budget of the others. Over its
+                    # budget the newest value is held back and delivered once the coil has budget again.
+                    if key in self._held_commands or not bucket.allow():
+                        self._hold_command(key, value)
+                        return None
+                    if not self._command_bucket.allow():
+                        reason = "rate_limited"
+
+        if reason is not None:
+            commands_dropped[reason].inc()
+            logger.debug(f"Dropped MQTT command for {coil_name}: {reason.replace('_', ' ')}")
+            return None
+
+        return value
+
+    def _hold_command(self, key: tuple[str, str], value: str):
+        """Called with the command lock held."""
+        if key in self._held_commands:
+            commands_coalesced.inc()
+        elif self._loop is not None:
+            self._dispatch(self._deliver_held_command, key)
+        self._held_commands[key] = value
+        logger.debug(f"Holding back MQTT command for {key[1]} over its rate limit")
+
+    def _deliver_held_command(self, key: tuple[str, str]):
+        with self._command_lock:
+            bucket = self._coil_buckets[key]
+            delay = bucket.delay()
+            if delay <= 0:
+                bucket.allow()
+                value = self._held_commands.pop(key)
+                allowed = self._command_bucket.allow()
+
+        if delay > 0:
+            self._loop.call_later(delay, self._deliver_held_command, key)
+            return
+
+        prefix, coil_name = key
+        if not allowed:
+            commands_dropped["rate_limited"].inc()
+            logger.debug(f"Dropped MQTT command for {coil_name}: rate limited")
+            return
+
+        logger.info(f"Received MQTT command set {coil_name} to {value}")
+        self._handlers[prefix].handle_coil_set(coil_name, value)
+
+    def _dispatch(self, callback, *args):
+        # With asyncio network loop paho callbacks already run in the event loop thread
+        if self._asyncio:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
     def start(self):
+        if self._loop is not None:
+            return  # already started by another heat pump service
+
         # Store the event loop reference while we're in an async context
         # This is needed because MQTT callbacks run in a separate thread
         self._loop = asyncio.get_running_loop()
 
+        self._outbox.load()
+        if "spool" in self._conf["outbox"]:
+            self._spool_task = asyncio.create_task(self._spool_loop())
+
+        if self._asyncio:
+            self._client.on_socket_open = self._on_socket_open_cb
+            self._client.on_socket_close = self._on_socket_close_cb
+            self._client.on_socket_register_write = self._on_socket_register_write_cb
+            self._client.on_socket_unregister_write = self._on_socket_unregister_write_cb
+            self._network_task = asyncio.create_task(self._network_loop())
+            return
+
         self._client.connect_async(host=self._conf["host"], port=self._conf["port"])
 
         self._client.loop_start()
 
     def stop(self):
+        if self._aggregate_handle is not None:
+            self._aggregate_handle.cancel()
+            self._publish_aggregates()
+
+        if self._spool_task is not None:
+            self._spool_task.cancel()
+            self._outbox.save()
+
+        if self._asyncio:
+            if self._network_task is not None:
+                self._network_task.cancel()
+            self._client.disconnect()
+            return
+
         self._client.loop_stop()
 
-    def _get_coil_state_topic(self, coil: Coil):
-        return f"{self._conf['prefix']}/coils/{coil.name}"
+    async def _network_loop(self):
+        """Connects and reconnects the client while its socket is driven by the event loop."""
+        delay = self.RECONNECT_MIN_DELAY
+        while True:
+            self._socket_closed = asyncio.Event()
+            try:
+                # Name lookup and socket connect block, run them in a worker thread
+                await self._loop.run_in_executor(None, functools.partial(self._client.connect, host=self._conf["host"], port=self._conf["port"]))
+            except OSError as e:
+                logger.warning(f"MQTT connection failed: {e}, retrying in {delay:.0f}s")
+            else:
+                await self._socket_closed.wait()
+                delay = self.RECONNECT_MIN_DELAY
 
-    def publish_coil_state(self, coil_data: CoilData):
-        self._client.publish(
-            self._get_coil_state_topic(coil_data.coil),
-            coil_data.value,
-            retain=self._conf["retain_state"],
-        )
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
 
-    def publish_discovery(self, coil_data: CoilData, device_info: dict):
-        coil = coil_data.coil
-        component = "sensor"
+    async def _misc_loop(self):
+        while self._client.loop_misc() == MQTTErrorCode.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(self.MISC_INTERVAL)
+
+    def _in_loop(self, callback, *args):
+        """Run a socket callback in the event loop thread, paho also calls them from the connecting worker thread."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self._loop:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
 
+    def _on_socket_open_cb(self, client, userdata, sock):
+        self._in_loop(self._watch_socket, client, sock)
+
+    def _watch_socket(self, client, sock):
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc_task = self._loop.create_task(self._misc_loop())
+
+    def _on_socket_close_cb(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+        if self._socket_closed is not None:
+            self._socket_closed.set()
+
+    def _on_socket_register_write_cb(self, client, userdata, sock):
+        self._in_loop(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write_cb(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+    def _get_coil_state_topic(self, coil: Coil, prefix: str | None = None):
+        topics = self._coil_topics.get(prefix)
+        if topics is None:
+            topics = self._coil_topics[prefix] = {}
+
+        topic = topics.get(coil)
+        if topic is None:
+            # Built once per coil, the set topic is registered for command lookup at the same time
+            coil_prefix = prefix or self._conf["prefix"]
+            topic = topics[coil] = f"{coil_prefix}/coils/{coil.name}"
+            self._set_topics[f"{topic}/set"] = (coil_prefix, coil.name)
+
+        return topic
+
+    def _get_aggregate_topic(self, prefix: str | None = None):
+        return f"{prefix or self._conf['prefix']}/state"
+
+    def publish_coil_state(self, coil_data: CoilData, prefix: str | None = None):
+        start = time.perf_counter()
+        if self._aggregate is None or self._aggregate["per_coil"]:
+            self._publish_buffered(self._get_coil_state_topic(coil_data.coil, prefix), self._encode_value(coil_data), self._conf["retain_state"])
+        if self._aggregate is not None:
+            self._aggregate_coil_state(coil_data, prefix or self._conf["prefix"])
+        publish_seconds.observe(time.perf_counter() - start)
+
+    def _encode_value(self, coil_data: CoilData):
+        """Mapped values come from a small fixed set, their encoded payloads are reused. Numbers are left to paho."""
+        value = coil_data.value
+        if not isinstance(value, str) or not coil_data.coil.has_mappings:
+            return value
+
+        payload = self._encoded_values.get(value)
+        if payload is None:
+            payload = self._encoded_values[value] = value.encode("utf-8")
+
+        return payload
+
+    def _aggregate_coil_state(self, coil_data: CoilData, prefix: str):
+        """Collect the value into the JSON state document of the heat pump, published once per window."""
+        self._aggregates.setdefault(prefix, {})[coil_data.coil.name] = coil_data.value
+        self._aggregate_dirty.add(prefix)
+        if self._aggregate_handle is None:
+            self._aggregate_handle = asyncio.get_running_loop().call_later(self._aggregate["window"], self._publish_aggregates)
+
+    def _publish_aggregates(self):
+        self._aggregate_handle = None
+        for prefix in self._aggregate_dirty:
+            # Document holds the latest value of every coil so value templates always find their key
+            payload = json.dumps(self._aggregates[prefix], default=str)
+            self._publish_buffered(self._get_aggregate_topic(prefix), payload, self._conf["retain_state"])
+        self._aggregate_dirty.clear()
+
+    def publish_diagnostics(self, snapshot: dict):
+        if not self._connected:
+            return
+
+        for name, value in snapshot.items():
+            payload = json.dumps(value) if isinstance(value, dict) else value
+            self._client.publish(f"{self._conf['prefix']}/diagnostics/{name}", payload, retain=True)
+
+    def _publish_buffered(self, topic: str, payload, retain: bool):
+        """Publish or keep the latest payload in the outbox while the broker is unreachable."""
+        if self._connected:
+            self._outbox.discard(topic)
+            if self._client.publish(topic, payload, retain=retain).rc != MQTTErrorCode.MQTT_ERR_NO_CONN:
+                return
+
+        self._outbox.put(topic, payload, retain)
+
+    def _start_flush(self):
+        if len(self._outbox) and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._flush_outbox())
+
+    async def _flush_outbox(self):
+        delay = 1 / self._conf["outbox"]["flush_rate"]
+        while self._connected and len(self._outbox):
+            topic, payload, retain = self._outbox.pop()
+            self._client.publish(topic, payload, retain=retain)
+            await asyncio.sleep(delay)
+
+        logger.info(f"Outbox flushed: {self._outbox.stats()}")
+
+    async def _spool_loop(self):
+        while True:
+            await asyncio.sleep(self.SPOOL_INTERVAL)
+            if self._outbox.dirty:
+                await asyncio.to_thread(self._outbox.write_spool, self._outbox.dump())
+
+    @property
+    def outbox_stats(self) -> dict:
+        return self._outbox.stats()
+
+    def get_discovery(self, coil: Coil, device_info: dict, prefix: str | None = None) -> tuple[str, bytes]:
+        discovery = self._discovery_cache.get(coil)
+        if discovery is None:
+            discovery = self._discovery_cache[coil] = self._build_discovery(coil, device_info, prefix)
+
+        return discovery
+
+    def publish_discovery(self, coil: Coil, device_info: dict, prefix: str | None = None) -> bool:
+        """Return False when the config was not handed to the client, e.g. while disconnected."""
+        topic, payload = self.get_discovery(coil, device_info, prefix)
+        return self._client.publish(topic, payload, retain=self._conf["retain_state"]).rc == MQTTErrorCode.MQTT_ERR_SUCCESS
+
+    async def fetch_retained_discovery(self, device_id: str) -> dict[str, bytes]:
+        """Collect discovery configs of this device that are already retained on the broker."""
+        retained = {}
+
+        def on_message(client, userdata, msg: MQTTMessage):
+            if msg.retain:
+                self._dispatch(retained.__setitem__, msg.topic, msg.payload)
+
+        topic_filter = f"{self._conf['discovery_prefix']}/+/{device_id}/+/config"
+        self._client.message_callback_add(topic_filter, on_message)
+        self._client.subscribe(topic_filter)
+        try:
+            await asyncio.sleep(self.RETAINED_DISCOVERY_WAIT)
+        finally:
+            self._client.unsubscribe(topic_filter)
+            self._client.message_callback_remove(topic_filter)
+
+        return retained
+
+    def invalidate_discovery(self, coil: Coil):
+        self._discovery_cache.pop(coil, None)
+
+    def publish_command_status(self, coil: Coil, status: dict, prefix: str | None = None):
+        self._publish_buffered(f"{self._get_coil_state_topic(coil, prefix)}/status", json.dumps(status, default=str), self._conf["retain_state"])
+
+    def publish_coil_statistics(self, coil: Coil, statistics: dict, prefix: str | None = None):
+        self._publish_buffered(f"{self._get_coil_state_topic(coil, prefix)}/stats", json.dumps(statistics), self._conf["retain_state"])
+
+    def publish_statistics_discovery(self, coil: Coil, labels: list[str], device_info: dict, prefix: str | None = None):
+        """Announce a sensor for min, mean and max of each statistics window of the coil."""
         device_id = device_info.get("id")
-        device = {
+        for label in labels:
+            for statistic in STATISTICS:
+                unique_id = f"{device_id}_{coil.name}_{label}_{statistic}"
+                config = {
+                    "name": f"{coil.title} {label} {statistic}",
+                    "unique_id": unique_id,
+                    "state_topic": f"{self._get_coil_state_topic(coil, prefix)}/stats",
+                    "value_template": f"{{{{ value_json['{label}']['{statistic}'] }}}}",
+                    "availability_topic": self._availability_topic,
+                    "device": self._get_device(device_info),
+                    "state_class": "measurement",
+                    "default_entity_id": f"sensor.{unique_id}",
+                }
+                if coil.unit is not None:
+                    config["unit_of_measurement"] = coil.unit
+                self._client.publish(
+                    f"{self._conf['discovery_prefix']}/sensor/{device_id}/{coil.name}-{label}-{statistic}/config",
+                    json.dumps(config).encode("utf-8"),
+                    retain=self._conf["retain_state"],
+                )
+
+    @staticmethod
+    def _get_device(device_info: dict) -> dict:
+        return {
             "manufacturer": "Nibe",
             "name": device_info.get("name"),
             "model": device_info.get("model"),
-            "identifiers": [device_id],
+            "identifiers": [device_info.get("id")],
             # "sw_version": ""
         }
 
+    def _build_discovery(self, coil: Coil, device_info: dict, prefix: str | None = None) -> tuple[str, bytes]:
+        component = "sensor"
+
+        device_id = device_info.get("id")
+        device = self._get_device(device_info)
+
         unique_id = f"{device_id}_{coil.name}"
+        coil_topic = self._get_coil_state_topic(coil, prefix)
         config = {
             "name": coil.title,
             "unique_id": unique_id,
-            "state_topic": self._get_coil_state_topic(coil),
+            "state_topic": coil_topic,
             "availability_topic": self._availability_topic,
             "device": device,
         }
+        if self._aggregate is not None:
+            config["state_topic"] = self._get_aggregate_topic(prefix)
+            config["value_template"] = f"{{{{ value_json['{coil.name}'] }}}}"
         uom = coil.unit
         if uom is not None:
             config["unit_of_measurement"] = uom
@@ -136,7 +547,7 @@ class MqttConnection:
 
             if coil.is_writable:  # switch
                 component = "switch"
-                config["command_topic"] = f"{config['state_topic']}/set"
+                config["command_topic"] = f"{coil_topic}/set"
                 config["payload_on"] = on_value
                 config["payload_off"] = off_value
                 config["state_on"] = on_value
@@ -148,19 +559,18 @@ class MqttConnection:
         elif coil.is_writable:  # switch
             if coil.has_mappings:
                 component = "select"
-                config["command_topic"] = f"{config['state_topic']}/set"
+                config["command_topic"] = f"{coil_topic}/set"
                 config["options"] = list(coil.reverse_mappings.keys())
             else:
                 component = "number"
-                config["command_topic"] = f"{config['state_topic']}/set"
+                config["command_topic"] = f"{coil_topic}/set"
                 config["min"] = coil.min
                 config["max"] = coil.max
                 config["step"] = 1 / coil.factor
 
         config["default_entity_id"] = f"{component}.{unique_id}"
 
-        self._client.publish(
+        return (
             f"{self._conf['discovery_prefix']}/{component}/{device_id}/{coil.name}/config",
-            json.dumps(config),
-            retain=self._conf["retain_state"],
+            json.dumps(config).encode("utf-8"),
         )
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger("nibe").getChild(__name__)
+
+
+def _spool_payload(payload) -> str:
+    if payload is None:
+        return ""
+    if isinstance(payload, bytes):
+        return payload.decode("utf-8")
+
+    return str(payload)
+
+
+class Outbox:
+    """Holds the latest payload per topic while the broker is unreachable.
+
+    When full, the topic that has not been updated for the longest time is dropped."""
+
+    def __init__(self, max_size: int, spool: Path | None = None):
+        self._max_size = max_size
+        self._spool = spool
+        self._messages: OrderedDict[str, tuple[object, bool]] = OrderedDict()
+
+        self.dropped = 0
+        self.flushed = 0
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, topic: str, payload, retain: bool):
+        self._messages[topic] = (payload, retain)
+        self._messages.move_to_end(topic)
+        if len(self._messages) > self._max_size:
+            self._messages.popitem(last=False)
+            self.dropped += 1
+        self.dirty = True
+
+    def discard(self, topic: str):
+        if self._messages.pop(topic, None) is not None:
+            self.dirty = True
+
+    def pop(self) -> tuple[str, object, bool]:
+        topic, (payload, retain) = self._messages.popitem(last=False)
+        self.flushed += 1
+        self.dirty = True
+        return topic, payload, retain
+
+    def stats(self) -> dict:
+        return {"depth": len(self._messages), "dropped": self.dropped, "flushed": self.flushed}
+
+    def load(self):
+        if self._spool is None or not self._spool.is_file():
+            return
+
+        try:
+            with self._spool.open("r", encoding="utf-8") as fh:
+                for topic, payload, retain in json.load(fh):
+                    self.put(topic, payload, retain)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load outbox spool {self._spool}: {e}")
+            return
+
+        self.dirty = False
+        logger.info(f"Loaded {len(self._messages)} messages from outbox spool {self._spool}")
+
+    def dump(self) -> list:
+        self.dirty = False
+        return [[topic, _spool_payload(payload), retain] for topic, (payload, retain) in self._messages.items()]
+
+    def write_spool(self, messages: list):
+        """Write dumped messages to the spool file. Spool is removed once the outbox is empty."""
+        if self._spool is None:
+            return
+
+        try:
+            if not messages:
+                self._spool.unlink(missing_ok=True)
+                return
+
+            tmp = self._spool.with_suffix(self._spool.suffix + ".tmp")
+            with tmp.open("w", encoding="utf-8") as fh:
+                json.dump(messages, fh)
+            os.replace(tmp, self._spool)
+        except OSError as e:
+            logger.warning(f"Failed to write outbox spool {self._spool}: {e}")
+
+    def save(self):
+        self.write_spool(self.dump())
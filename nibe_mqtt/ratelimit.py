@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+import time
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average with bursts of up to `burst` events."""
+
+    __slots__ = ("rate", "burst", "_tokens", "_updated")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float | None) -> None:
+        now = time.monotonic() if now is None else now
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def allow(self, now: float | None = None) -> bool:
+        self._refill(now)
+        if self._tokens < 1:
+            return False
+
+        self._tokens -= 1
+        return True
+
+    def delay(self, now: float | None = None) -> float:
+        """Seconds until `allow` succeeds."""
+        self._refill(now)
+        return max(0.0, (1 - self._tokens) / self.rate)
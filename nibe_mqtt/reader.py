@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from collections.abc import Awaitable
+from contextlib import AbstractAsyncContextManager
+from dataclasses import dataclass, field
+from typing import Callable
+
+from nibe.coil import Coil
+from nibe.connection import DEFAULT_TIMEOUT, Connection
+from nibe.exceptions import (
+    ReadException,
+    ReadIOException,
+    ReadTimeoutException,
+)
+from nibe.heatpump import HeatPump
+
+from nibe_mqtt.metrics import registry
+
+logger = logging.getLogger("nibe").getChild(__name__)
+
+ReadCoil = Callable[[Coil], Awaitable]
+ReadFailures = list[tuple[Coil, Exception]]
+
+MODBUS_MAX_BLOCK_LENGTH = 125  # max registers in one read request allowed by Modbus spec
+
+block_reads = registry.counter("nibe_mqtt_modbus_block_reads_total", "Modbus range reads covering several coils")
+block_fallbacks = registry.counter("nibe_mqtt_modbus_block_fallbacks_total", "Coils read one by one after their block read failed")
+
+
+class CoilReader(ABC):
+    """Reads a group of coils. Values are delivered through heatpump coil update events."""
+
+    @abstractmethod
+    async def read_coils(self, coils: list[Coil]) -> ReadFailures:
+        """Read coils and return the ones that failed together with the exception."""
+        pass
+
+
+class SequentialCoilReader(CoilReader):
+    def __init__(self, read_coil: ReadCoil):
+        self._read_coil = read_coil
+
+    async def read_coils(self, coils: list[Coil]) -> ReadFailures:
+        failures = []
+        for coil in coils:
+            try:
+                await self._read_coil(coil)
+            except Exception as e:
+                failures.append((coil, e))
+
+        return failures
+
+
+class ConcurrentCoilReader(CoilReader):
+    def __init__(self, read_coil: ReadCoil, concurrency: int):
+        self._read_coil = read_coil
+        self._concurrency = concurrency
+
+    async def read_coils(self, coils: list[Coil]) -> ReadFailures:
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        async def read(coil: Coil):
+            async with semaphore:
+                await self._read_coil(coil)
+
+        results = await asyncio.gather(*(read(coil) for coil in coils), return_exceptions=True)
+
+        return [(coil, result) for coil, result in zip(coils, results) if isinstance(result, Exception)]
+
+
+@dataclass
+class ModbusBlock:
+    entity_type: int
+    start: int
+    count: int = 0
+    coils: list[tuple[Coil, slice]] = field(default_factory=list)
+
+    @property
+    def end(self) -> int:
+        return self.start + self.count
+
+    def add(self, coil: Coil, entity_address: int, entity_count: int):
+        offset = entity_address - self.start
+        self.coils.append((coil, slice(offset, offset + entity_count)))
+        self.count = max(self.count, entity_address + entity_count - self.start)
+
+
+class ModbusBlockReader(CoilReader):
+    """Merges coils with nearby register addresses into a single range read.
+
+    Registers between coils are read and discarded when the gap is at most `max_gap`. Coils of a block that fails,
+    or that fail to decode, are read one by one."""
+
+    def __init__(
+        self,
+        connection: Connection,
+        heatpump: HeatPump,
+        read_coil: ReadCoil,
+        timeout: float = DEFAULT_TIMEOUT,
+        bus_slot: Callable[[], AbstractAsyncContextManager] | None = None,
+        max_gap: int = 0,
+        max_length: int = MODBUS_MAX_BLOCK_LENGTH,
+    ):
+        """`bus_slot` is entered around each block read so block reads share the bus arbiter with single reads."""
+        self._connection = connection
+        self._heatpump = heatpump
+        self._read_coil = read_coil
+        self._timeout = timeout
+        self._bus_slot = bus_slot
+        self._max_gap = max_gap
+        self._max_length = max_length
+
+    @staticmethod
+    def plan(coils: list[Coil], max_gap: int = 0, max_length: int = MODBUS_MAX_BLOCK_LENGTH) -> list[ModbusBlock]:
+        from nibe.connection.modbus import split_modbus_data
+
+        blocks: list[ModbusBlock] = []
+        for coil in sorted(coils, key=split_modbus_data):
+            entity_type, entity_address, entity_count = split_modbus_data(coil)
+            block = blocks[-1] if blocks else None
+            if (
+                block is None
+                or block.entity_type != entity_type
+                or entity_address > block.end + max_gap
+                or entity_address + entity_count - block.start > max_length
+            ):
+                block = ModbusBlock(entity_type, entity_address)
+                blocks.append(block)
+            block.add(coil, entity_address, entity_count)
+
+        return blocks
+
+    async def read_coils(self, coils: list[Coil]) -> ReadFailures:
+        single = []
+        for block in self.plan(coils, self._max_gap, self._max_length):
+            if len(block.coils) == 1:
+                single.append(block.coils[0][0])
+                continue
+
+            try:
+                if self._bus_slot is None:
+                    registers = await self._read_block(block)
+                else:
+                    async with self._bus_slot():
+                        registers = await self._read_block(block)
+            except Exception as e:
+                logger.debug(f"Block read starting: {block.start} count: {block.count} failed, reading its coils one by one: {e}")
+                block_fallbacks.inc(len(block.coils))
+                single.extend(coil for coil, _ in block.coils)
+                continue
+            block_reads.inc()
+
+            for coil, registers_slice in block.coils:
+                try:
+                    coil_data = self._connection.coil_encoder.decode(coil, registers[registers_slice])
+                except Exception as e:  # unexpected register values raise more than DecodeException
+                    logger.debug(f"Failed decoding {coil.name} from block, reading it alone: {e}")
+                    block_fallbacks.inc()
+                    single.append(coil)
+                    continue
+
+                self._heatpump.notify_coil_update(coil_data)
+
+        failures = []
+        for coil in single:
+            try:
+                await self._read_coil(coil)
+            except Exception as e:
+                failures.append((coil, e))
+
+        return failures
+
+    async def _read_block(self, block: ModbusBlock) -> list:
+        from umodbus.exceptions import ModbusError
+
+        # Modbus connection does not expose range reads, so we use its client directly
+        client = self._connection._client
+        read = {
+            0: client.read_coils,
+            1: client.read_discrete_inputs,
+            3: client.read_input_registers,
+            4: client.read_holding_registers,
+        }.get(block.entity_type)
+        if read is None:
+            raise ReadException(f"Unsupported entity type {block.entity_type}")
+
+        logger.debug(f"Reading block type: {block.entity_type} starting: {block.start} count: {block.count} ({len(block.coils)} coils)")
+        try:
+            async with self._connection._send_lock:
+                return list(
+                    await asyncio.wait_for(
+                        read(slave_id=self._connection._slave_id, starting_address=block.start, quantity=block.count),
+                        self._timeout,
+                    )
+                )
+        except (ModbusError, asyncio.IncompleteReadError) as e:
+            raise ReadIOException(f"Error '{str(e)}' reading block starting: {block.start} count: {block.count}") from e
+        except asyncio.TimeoutError as e:
+            raise ReadTimeoutException(f"Timeout waiting for block read starting: {block.start} count: {block.count}") from e
@@ -1,45 +1,114 @@
 from __future__ import annotations
 
 import asyncio
+import datetime
+import functools
+import heapq
+import itertools
 import logging
+import os
 import re
-from datetime import datetime, timedelta
+import signal
+import time
 from pathlib import Path
 
 from nibe.coil import Coil, CoilData
 from nibe.connection import Connection
 from nibe.exceptions import CoilNotFoundException, NoMappingException, WriteException
 from nibe.heatpump import HeatPump
-from slugify import slugify
 
 from nibe_mqtt import cfg
+from nibe_mqtt.adaptive import AdaptiveInterval
+from nibe_mqtt.arbiter import BusArbiter, Priority
+from nibe_mqtt.config import changed_keys
+from nibe_mqtt.filter import StateFilter
+from nibe_mqtt.heatpump import LazyHeatPump
+from nibe_mqtt.history import HistorySink
+from nibe_mqtt.metrics import MetricsServer, registry
 from nibe_mqtt.mqtt import MqttConnection, MqttHandler
+from nibe_mqtt.reader import (
+    CoilReader,
+    ConcurrentCoilReader,
+    ModbusBlockReader,
+    SequentialCoilReader,
+)
+from nibe_mqtt.snapshot import StateSnapshot, discovery_hash
+from nibe_mqtt.statistics import StatisticsAggregator
+from nibe_mqtt.watchdog import LoopWatchdog
+from nibe_mqtt.writer import WriteQueue
 
 logger = logging.getLogger("nibe").getChild(__name__)
 
+coil_updates = registry.counter("nibe_mqtt_coil_updates_total", "Coil updates received from the heat pump")
+coil_writes = registry.counter("nibe_mqtt_coil_writes_total", "Coil writes requested over MQTT")
+coil_write_failures = registry.counter("nibe_mqtt_coil_write_failures_total", "Coil writes that failed")
+poll_reads = registry.counter("nibe_mqtt_poll_reads_total", "Coils read by the poller")
+poll_failures = registry.counter("nibe_mqtt_poll_failures_total", "Coil polls that failed")
+poll_sweep_seconds = registry.histogram("nibe_mqtt_poll_sweep_seconds", "Duration of a poll sweep")
+
 
 class Service(MqttHandler):
     announced_coils: set[Coil]
     re_unknown_value = re.compile(r"UNKNOWN \((\d+)\)")
 
-    def __init__(self, conf: dict):
+    def __init__(self, conf: dict, nibe_conf: dict | None = None, mqtt_client: MqttConnection | None = None, poller: PollService | None = None):
+        """Service for a single heat pump.
+
+        When `nibe_conf` is not given the `nibe` block of `conf` is used. MQTT connection and poller can be shared
+        between several services, in that case they are started by `run_service`."""
         self.conf = conf
-        self.heatpump = HeatPump(conf["nibe"]["model"])
-        self.heatpump.word_swap = conf["nibe"]["word_swap"]
+        self.nibe_conf = conf["nibe"] if nibe_conf is None else nibe_conf
+        self.prefix = self.nibe_conf.get("prefix") or conf["mqtt"]["prefix"]
+        self.heatpump = (LazyHeatPump if self.nibe_conf["lazy_coils"] else HeatPump)(self.nibe_conf["model"])
+        self.heatpump.word_swap = self.nibe_conf["word_swap"]
         self.announced_coils = set()
+        self._restored_announced: set[Coil] = set()
+
+        self.snapshot = None
+        if "snapshot" in self.nibe_conf:
+            self.snapshot = StateSnapshot(Path(self.nibe_conf["snapshot"]["path"]))
+
+        self.history = None
+        if "history" in self.nibe_conf:
+            self.history = HistorySink(Path(self.nibe_conf["history"]["path"]), self.nibe_conf["history"].get("keep_days"))
 
         self.heatpump.subscribe(HeatPump.COIL_UPDATE_EVENT, self.on_coil_update)
 
-        if "nibegw" in conf["nibe"]:
-            self.connection = self._get_nibegw_connection(conf["nibe"]["nibegw"])
-        elif "modbus" in conf["nibe"]:
-            self.connection = self._get_modbus_connection(conf["nibe"]["modbus"])
+        if "nibegw" in self.nibe_conf:
+            self.connection = self._get_nibegw_connection(self.nibe_conf["nibegw"])
+        elif "modbus" in self.nibe_conf:
+            self.connection = self._get_modbus_connection(self.nibe_conf["modbus"])
         else:
             raise AssertionError("Invalid or no connection type specified")
 
-        self.poller = None
+        self.arbiter = BusArbiter(self.nibe_conf["bus"]["concurrency"], self.nibe_conf["bus"]["rate"])
+
+        self._standalone = mqtt_client is None
+        self.poller = PollService() if poller is None else poller
+        self.metrics_server = None
+        self._announce_task = None
+
+        self.state_filter = None
+        if "state_filter" in conf["mqtt"]:
+            self.state_filter = StateFilter(conf["mqtt"]["state_filter"])
+
+        self.statistics = None
+        self._announced_statistics: set[Coil] = set()
+        if "statistics" in conf["mqtt"]:
+            self.statistics = StatisticsAggregator(conf["mqtt"]["statistics"])
+
+        write_conf = self.nibe_conf["write"]
+        self.writer = WriteQueue(
+            self.write_coil,
+            self.get_coil_reader(batch=True, concurrency=write_conf["concurrency"], priority=Priority.READBACK),
+            concurrency=write_conf["concurrency"],
+            readback_delay=write_conf["readback_delay"],
+            on_status=self._publish_command_status,
+        )
 
-        self.mqtt_client = MqttConnection(self, conf["mqtt"])
+        self.mqtt_client = MqttConnection(None, conf["mqtt"]) if mqtt_client is None else mqtt_client
+        self.mqtt_client.add_handler(self.prefix, self)
+        self.device_info = self._get_device_info()
 
     def _get_nibegw_connection(self, conn_conf) -> Connection:
         from nibe.connection.nibegw import NibeGW
@@ -64,15 +133,17 @@ class Service(MqttHandler):
         )
 
     def _get_device_info(self) -> dict:
-        if "nibegw" in self.conf["nibe"]:
-            address = self.conf["nibe"]["nibegw"]["ip"]
-        elif "modbus" in self.conf["nibe"]:
-            address = self.conf["nibe"]["modbus"]["url"] + f"-{self.conf['nibe']['modbus']['slave_id']}"
+        from slugify import slugify
+
+        if "nibegw" in self.nibe_conf:
+            address = self.nibe_conf["nibegw"]["ip"]
+        elif "modbus" in self.nibe_conf:
+            address = self.nibe_conf["modbus"]["url"] + f"-{self.nibe_conf['modbus']['slave_id']}"
         else:
             raise AssertionError("Connection type not supported")
 
         return {
-            "model": self.conf["nibe"]["model"].name,
+            "model": self.nibe_conf["model"].name,
             "name": "Nibe heatpump integration",
             "id": slugify("Nibe " + address),
         }
@@ -83,7 +154,7 @@ class Service(MqttHandler):
             converted_value = self._convert_mqtt_value_for_coil(coil, value)
             coil_data = CoilData(coil, converted_value)
 
-            asyncio.create_task(self.write_coil(coil_data))
+            self.writer.submit(coil_data)
         except (AssertionError, CoilNotFoundException) as e:
             logger.error(e)
         except Exception:
@@ -108,44 +179,144 @@ class Service(MqttHandler):
 
         return value
 
-    async def read_coil(self, coil: Coil):
-        return await self.connection.read_coil(coil)
-
-    async def write_coil(self, coil_data: CoilData) -> None:
-        refresh_required = True
+    def get_coil_reader(self, batch: bool, concurrency: int, priority: Priority = Priority.POLL) -> CoilReader:
+        read_coil = functools.partial(self.read_coil, priority=priority)
+        if not batch:
+            return SequentialCoilReader(read_coil)
+        if "modbus" in self.nibe_conf:
+            modbus_conf = self.nibe_conf["modbus"]
+            return ModbusBlockReader(
+                self.connection,
+                self.heatpump,
+                read_coil,
+                bus_slot=functools.partial(self.arbiter.slot, priority),
+                max_gap=modbus_conf["max_gap"],
+                max_length=modbus_conf["max_block_length"],
+            )
+
+        return ConcurrentCoilReader(read_coil, concurrency)
+
+    async def read_coil(self, coil: Coil, priority: Priority = Priority.POLL):
+        return await self.arbiter.read(coil, self.connection.read_coil, priority)
+
+    async def write_coil(self, coil_data: CoilData) -> bool:
+        coil_writes.inc()
         try:
-            await self.connection.write_coil(coil_data)
+            await self.arbiter.run(Priority.WRITE, self.connection.write_coil, coil_data)
+            return True
         except WriteException as e:
+            coil_write_failures.inc()
             logger.error(e)
         except Exception:
+            coil_write_failures.inc()
             logger.exception("Unhandled exception during write")
 
-        if refresh_required:
-            try:
-                await self.read_coil(coil_data.coil)
-            except Exception:
-                logger.exception("Unhandled exception during read")
+        return False
+
+    def _get_writable_coil_names(self) -> frozenset[str]:
+        if isinstance(self.heatpump, LazyHeatPump):
+            return self.heatpump.get_writable_coil_names()
+
+        return frozenset(coil.name for coil in self.heatpump.get_coils() if coil.is_writable)
+
+    def _publish_command_status(self, coil: Coil, status: dict):
+        self.mqtt_client.publish_command_status(coil, status, self.prefix)
 
     async def start(self):
         await self.heatpump.initialize()
+        self.mqtt_client.set_writable_coils(self.prefix, self._get_writable_coil_names())
+
+        ages = {}
+        if self.snapshot is not None:
+            ages = self._restore_snapshot()
+            asyncio.create_task(self._snapshot_loop(self.nibe_conf["snapshot"]["interval"]))
+
+        if self.history is not None:
+            asyncio.create_task(self._history_loop(self.nibe_conf["history"]["flush_interval"]))
+
         await self.connection.start()
 
-        poll_config = self.conf["nibe"].get("poll")
+        poll_config = self.nibe_conf.get("poll")
         if poll_config is not None:
-            self.poller = PollService(self, poll_config)
-            self.poller.start()
+            self.poller.add_service(self, poll_config, ages)
+
+        if self.statistics is not None:
+            asyncio.create_task(self._statistics_loop())
+
+        if self._standalone:
+            self.metrics_server = await start_shared(self.conf, self.mqtt_client, self.poller)
 
-        self.mqtt_client.start()
+    def stop(self):
+        """Save state that is otherwise written periodically. The MQTT connection may be shared, its owner stops it."""
+        if self.snapshot is not None:
+            self.snapshot.save()
+        if self.history is not None:
+            self.history.save()
+
+    def _restore_snapshot(self) -> dict[Coil, float]:
+        """Apply learned mappings and republish last known values. Returns age in seconds of each restored value.
+
+        Coils whose discovery config is unchanged since the snapshot are not announced again on first connect."""
+        self.snapshot.load()
+
+        now = time.time()
+        ages = {}
+        for name, entry in self.snapshot.items():
+            try:
+                coil = self.heatpump.get_coil_by_name(name)
+            except CoilNotFoundException:
+                continue
+
+            if "mappings" in entry:
+                coil.set_mappings({**coil.mappings, **entry["mappings"]})
+
+            if "discovery" in entry:
+                _, payload = self.mqtt_client.get_discovery(coil, self.device_info, self.prefix)
+                if discovery_hash(payload) == entry["discovery"]:
+                    self.announced_coils.add(coil)
+                    self._restored_announced.add(coil)
+
+            if "value" in entry:
+                value = entry["value"]
+                if coil.is_date and value is not None:
+                    value = datetime.date.fromisoformat(value)
+                ages[coil] = max(now - entry["time"], 0.0)
+                self._publish_coil_updates(CoilData(coil, value))
+
+        logger.info(f"Restored {len(ages)} coil values from snapshot")
+        return ages
+
+    async def _snapshot_loop(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            if self.snapshot.dirty:
+                await asyncio.to_thread(self.snapshot.write, *self.snapshot.dump())
+
+    async def _history_loop(self, interval: int):
+        while True:
+            await asyncio.sleep(interval)
+            if len(self.history):
+                await asyncio.to_thread(self.history.write, *self.history.dump())
 
     def on_coil_update(self, coil_data: CoilData):
+        coil_updates.inc()
         coil = coil_data.coil
-        if coil.has_mappings and isinstance(coil_data.value, str):
+        self.writer.on_coil_update(coil_data)
+        if coil.has_mappings and isinstance(coil_data.value, str) and coil_data.value not in coil.reverse_mappings:
             self._update_coil_mappings(coil, coil_data.value)
 
+        if self.snapshot is not None:
+            self.snapshot.update(coil.name, value=coil_data.value, time=time.time())
+
+        if self.statistics is not None:
+            self.statistics.add(coil, coil_data.value)
+
+        if self.history is not None:
+            self.history.add(coil, coil_data.value)
+
         self._publish_coil_updates(coil_data)
 
-        if self.poller is not None:
-            self.poller.register_update(coil)
+        self.poller.register_update(coil, coil_data.value)
 
     def _update_coil_mappings(self, coil, value):
         try:
@@ -160,73 +331,498 @@ class Service(MqttHandler):
                 unknown_value = int(match.group(1))
                 current_mappings[str(unknown_value)] = value
                 coil.set_mappings(current_mappings)
+                if self.snapshot is not None:
+                    learned = self.snapshot.get(coil.name).get("mappings", {})
+                    self.snapshot.update(coil.name, mappings={**learned, str(unknown_value): value})
+                self.mqtt_client.invalidate_discovery(coil)
                 self.announced_coils.discard(coil)
 
     def _publish_coil_updates(self, coil_data):
         coil = coil_data.coil
+        if self.statistics is not None and not self.statistics.publishes_raw(coil):
+            return
+
         if coil not in self.announced_coils:
-            self.mqtt_client.publish_discovery(coil_data, self._get_device_info())
+            self._publish_discovery(coil)
             self.announced_coils.add(coil)
 
-        self.mqtt_client.publish_coil_state(coil_data)
+        if self.state_filter is None or self.state_filter.should_publish(coil_data):
+            self.mqtt_client.publish_coil_state(coil_data, self.prefix)
 
-    def on_mqtt_connected(self):
-        self.announced_coils.clear()
+    def _publish_discovery(self, coil: Coil):
+        # Only a config that reached the broker may be trusted after a restart
+        if self.mqtt_client.publish_discovery(coil, self.device_info, self.prefix) and self.snapshot is not None:
+            _, payload = self.mqtt_client.get_discovery(coil, self.device_info, self.prefix)
+            self.snapshot.update(coil.name, discovery=discovery_hash(payload))
 
+    async def _statistics_loop(self):
+        bucket = self.statistics.bucket_seconds
+        while True:
+            # Align buckets to wall clock so windows end on whole minutes
+            await asyncio.sleep(bucket - time.time() % bucket)
+            self._publish_statistics()
 
-class PollService:
-    LAST_UPDATE_ATTR = "last_update"
+    def _publish_statistics(self):
+        for coil, statistics in self.statistics.roll().items():
+            if coil not in self._announced_statistics:
+                self.mqtt_client.publish_statistics_discovery(coil, self.statistics.labels, self.device_info, self.prefix)
+                self._announced_statistics.add(coil)
+            self.mqtt_client.publish_coil_statistics(coil, statistics, self.prefix)
 
-    def __init__(self, service: Service, conf: dict):
-        self._service = service
-        self._heatpump = service.heatpump
+    def on_mqtt_connected(self):
+        self.announced_coils.clear()
+        self._announced_statistics.clear()
+        # Discovery restored from the snapshot is still retained on the broker, trust it for the first connect only
+        self.announced_coils.update(self._restored_announced)
+        self._restored_announced = set()
+        if self.state_filter is not None:
+            self.state_filter.clear()
+
+        if "announce" in self.conf["mqtt"]:
+            if self._announce_task is not None:
+                self._announce_task.cancel()
+            self._announce_task = asyncio.create_task(self._announce_discovery(self.conf["mqtt"]["announce"]))
+
+    def _get_announce_coils(self, announce_conf: dict) -> list[Coil]:
+        coils = self.heatpump.get_coils() if announce_conf["coils"] == "all" else self.poller.get_coils(self)
+        if self.statistics is None:
+            return coils
+
+        # Coils published only as statistics have no raw state entity
+        return [coil for coil in coils if self.statistics.publishes_raw(coil)]
+
+    async def _announce_discovery(self, announce_conf: dict):
+        retained = {}
+        if announce_conf["diff"]:
+            retained = await self.mqtt_client.fetch_retained_discovery(self.device_info["id"])
+
+        published = skipped = 0
+        for coil in self._get_announce_coils(announce_conf):
+            if coil in self.announced_coils:
+                continue
+
+            topic, payload = self.mqtt_client.get_discovery(coil, self.device_info, self.prefix)
+            if retained.get(topic) == payload:
+                skipped += 1
+            else:
+                self._publish_discovery(coil)
+                published += 1
+                await asyncio.sleep(1 / announce_conf["rate"])
+            self.announced_coils.add(coil)
 
-        self._interval = conf["interval"]
-        self._coils = [self._get_coil(key) for key in conf["coils"]]
+        logger.info(f"Announced discovery for {published} coils, {skipped} unchanged")
 
-    def _get_coil(self, name_or_address: str | int):
+
+class PollService:
+    """Poll scheduler shared by the services of all configured heat pumps."""
+
+    STARTUP_DELAY = 5.0
+    RETRY_DELAY = 5.0
+    BATCH_WINDOW = 1.0
+
+    def __init__(self, service: Service | None = None, conf: dict | None = None):
+        self._intervals: dict[Coil, float] = {}
+        self._readers: dict[Coil, CoilReader] = {}
+        self._adaptive: dict[Coil, AdaptiveInterval] = {}
+        self._polling: set[Coil] = set()
+        self._service_coils: dict[Service, list[Coil]] = {}
+
+        self._last_update: dict[Coil, float] = {}
+        self._deadlines: dict[Coil, float] = {}
+        self._queue: list[tuple[float, int, Coil]] = []
+        self._entries: dict[Coil, int] = {}
+        self._queued: dict[Coil, float] = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        registry.gauge("nibe_mqtt_poll_push_covered_coils", "Polled coils currently kept fresh by pump pushes", self._count_push_covered)
+
+        if service is not None:
+            self.add_service(service, conf)
+
+    def add_service(self, service: Service, conf: dict, ages: dict[Coil, float] | None = None):
+        """Schedule polling of the service coils.
+
+        `ages` holds seconds since the last known update of coils restored from a snapshot, their first poll is
+        deferred until their interval passes."""
+        self._add_coils(service, conf, self.resolve_coils(service.heatpump, conf), ages)
+
+    def _add_coils(self, service: Service, conf: dict, intervals: list[tuple[Coil, float]], ages: dict[Coil, float] | None):
+        reader = service.get_coil_reader(conf["batch"], conf.get("concurrency", service.nibe_conf["bus"]["concurrency"]))
+        now = time.monotonic()
+        first_poll = now + self.STARTUP_DELAY
+        ages = ages or {}
+
+        coils = []
+        for coil, interval in intervals:
+            coils.append(coil)
+            self._intervals[coil] = interval
+            self._readers[coil] = reader
+            if "adaptive" in conf:
+                self._adaptive[coil] = AdaptiveInterval(interval, conf["adaptive"]["max_interval"], conf["adaptive"]["backoff"])
+            if coil in ages:
+                self._last_update[coil] = now - ages[coil]
+                self._schedule(coil, max(first_poll, now + interval - ages[coil]))
+            else:
+                self._schedule(coil, first_poll)
+
+        self._service_coils[service] = coils
+        self._wakeup.set()
+
+    def remove_service(self, service: Service):
+        for coil in self._service_coils.pop(service, []):
+            for state in (self._intervals, self._readers, self._adaptive, self._last_update, self._deadlines, self._entries, self._queued):
+                state.pop(coil, None)
+
+    def update_service(self, service: Service, conf: dict | None):
+        """Replace the polled coils of a service. Coils that stay polled keep their time of last update.
+
+        New coils are resolved before anything changes, an unknown coil raises and leaves the running schedule as is."""
+        intervals = self.resolve_coils(service.heatpump, conf) if conf is not None else []
+        now = time.monotonic()
+        ages = {coil: now - self._last_update[coil] for coil in self.get_coils(service) if coil in self._last_update}
+
+        self.remove_service(service)
+        if conf is not None:
+            self._add_coils(service, conf, intervals, ages)
+
+    @classmethod
+    def resolve_coils(cls, heatpump: HeatPump, conf: dict) -> list[tuple[Coil, float]]:
+        """Coils and poll intervals of a poll config. Raises CoilNotFoundException for unknown coils."""
+        intervals = []
+        for item in conf["coils"]:
+            if isinstance(item, dict):
+                intervals.append((cls._get_coil(heatpump, item["coil"]), item.get("interval", conf["interval"])))
+            else:
+                intervals.append((cls._get_coil(heatpump, item), conf["interval"]))
+
+        return intervals
+
+    @staticmethod
+    def _get_coil(heatpump: HeatPump, name_or_address: str | int):
         if isinstance(name_or_address, str):
-            return self._heatpump.get_coil_by_name(name_or_address)
+            return heatpump.get_coil_by_name(name_or_address)
         if isinstance(name_or_address, int):
-            return self._heatpump.get_coil_by_address(name_or_address)
+            return heatpump.get_coil_by_address(name_or_address)
 
     def start(self):
-        asyncio.create_task(self._loop())
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    def _schedule(self, coil: Coil, deadline: float):
+        entry = self._entries[coil] = next(self._counter)
+        self._deadlines[coil] = self._queued[coil] = deadline
+        heapq.heappush(self._queue, (deadline, entry, coil))
 
     async def _loop(self):
         while True:
-            await asyncio.sleep(5.0)
-            for coil in self._coils:
-                last_update = getattr(coil, self.LAST_UPDATE_ATTR, None)
-                if last_update is None or last_update + timedelta(seconds=self._interval) < datetime.now():
-                    logger.info(f"Polling coil {coil.name}: last_update = {last_update}")
-                    try:
-                        await self._service.read_coil(coil)
-                    except Exception as e:
-                        logger.warning(f"Poll {coil.name} failed: {e}")
-
-    def register_update(self, coil: Coil):
-        setattr(coil, self.LAST_UPDATE_ATTR, datetime.now())
-
-
-async def run_service(config_path: Path | str, log_version: str = None):
-    """Run the Nibe MQTT service with the given configuration file."""
+            delay = self._queue[0][0] - time.monotonic() if self._queue else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            try:
+                await self._poll_due()
+            except Exception:
+                logger.exception("Polling failed")
+
+    def _pop_due(self) -> list[Coil]:
+        """Pop coils that are due now or within the batch window.
+
+        Queue holds one live entry per coil, entries left behind by removed or rescheduled coils are skipped.
+        Updates that move a deadline later leave the queue as is, so an entry that is found to be early is pushed
+        back with the current deadline instead of being polled."""
+        horizon = time.monotonic() + self.BATCH_WINDOW
+        due = []
+        while self._queue and self._queue[0][0] <= horizon:
+            _, entry, coil = heapq.heappop(self._queue)
+            if self._entries.get(coil) != entry:
+                continue
+            if self._deadlines[coil] > horizon:
+                self._schedule(coil, self._deadlines[coil])
+            else:
+                due.append(coil)
+
+        return due
+
+    async def _poll_due(self):
+        due = self._pop_due()
+        if not due:
+            return
+
+        now = time.monotonic()
+        for coil in due:
+            last_update = self._last_update.get(coil)
+            since = f"{now - last_update:.0f}s ago" if last_update is not None else "never"
+            logger.info(f"Polling coil {coil.name}: last update {since}")
+
+        groups: dict[CoilReader, list[Coil]] = {}
+        for coil in due:
+            groups.setdefault(self._readers[coil], []).append(coil)
+
+        failed = set()
+        self._polling.update(due)
+        try:
+            with poll_sweep_seconds.time():
+                results = await asyncio.gather(*(reader.read_coils(coils) for reader, coils in groups.items()), return_exceptions=True)
+        finally:
+            self._polling.difference_update(due)
+        failures = []
+        for coils, result in zip(groups.values(), results):
+            if isinstance(result, Exception):
+                logger.exception("Coil reader failed", exc_info=result)
+                failures.extend((coil, result) for coil in coils)
+            else:
+                failures.extend(result)
+        poll_reads.inc(len(due))
+        poll_failures.inc(len(failures))
+        for coil, e in failures:
+            logger.warning(f"Poll {coil.name} failed: {e}")
+            failed.add(coil)
+
+        now = time.monotonic()
+        for coil in due:
+            if coil not in self._intervals:
+                continue  # removed by a config reload while being polled
+            if coil in failed:
+                self._schedule(coil, now + self.RETRY_DELAY)
+            else:
+                self._schedule(coil, now + self._next_poll(coil, now))
+
+    @property
+    def coils(self) -> list[Coil]:
+        return list(self._intervals)
+
+    def get_coils(self, service: Service) -> list[Coil]:
+        return self._service_coils.get(service, [])
+
+    def _next_poll(self, coil: Coil, now: float) -> float:
+        adaptive = self._adaptive.get(coil)
+        if adaptive is None:
+            return self._intervals[coil]
+
+        return adaptive.next_poll(now)
+
+    def _count_push_covered(self) -> int:
+        now = time.monotonic()
+        return sum(adaptive.is_push_covered(now) for adaptive in self._adaptive.values())
+
+    def register_update(self, coil: Coil, value=None):
+        """Defer the next poll of a coil that was just updated, by a poll or by a push from the pump."""
+        if coil not in self._intervals:
+            return
+
+        now = time.monotonic()
+        adaptive = self._adaptive.get(coil)
+        if adaptive is not None:
+            adaptive.update(value, now, pushed=coil not in self._polling)
+
+        self._last_update[coil] = now
+        deadline = self._deadlines[coil] = now + self._next_poll(coil, now)
+        if deadline < self._queued.get(coil, deadline):
+            # a changed value snapped a backed off interval back, the queued entry would poll too late
+            self._schedule(coil, deadline)
+            self._wakeup.set()
+
+
+def create_services(conf: dict) -> list[Service]:
+    """Create a service per configured heat pump, all sharing one MQTT connection and poll scheduler."""
+    if isinstance(conf["nibe"], dict):
+        return [Service(conf)]
+
+    mqtt_client = MqttConnection(None, conf["mqtt"])
+    poller = PollService()
+    return [Service(conf, nibe_conf, mqtt_client=mqtt_client, poller=poller) for nibe_conf in conf["nibe"]]
+
+
+async def start_shared(conf: dict, mqtt_client: MqttConnection, poller: PollService) -> MetricsServer | None:
+    """Start components shared by all heat pump services."""
+    poller.start()
+    mqtt_client.start()
+
+    metrics_server = None
+    metrics_conf = conf.get("metrics")
+    if metrics_conf is not None:
+        if "http_port" in metrics_conf:
+            metrics_server = MetricsServer(registry, metrics_conf["http_host"], metrics_conf["http_port"])
+            await metrics_server.start()
+
+        if metrics_conf["mqtt_interval"]:
+            asyncio.create_task(_publish_metrics_loop(mqtt_client, metrics_conf["mqtt_interval"]))
+
+    if "watchdog" in conf:
+        start_watchdog(conf["watchdog"], mqtt_client)
+
+    return metrics_server
+
+
+def start_watchdog(conf: dict, mqtt_client: MqttConnection) -> LoopWatchdog:
+    """Start the event loop watchdog. A profile is taken on SIGUSR1 or a `<prefix>/diagnostics/profile/set` message
+    with the number of seconds as payload."""
+    watchdog = LoopWatchdog(
+        conf["threshold"],
+        conf["sample_interval"],
+        Path(conf["profile_dir"]),
+        on_slow=lambda report: mqtt_client.publish_diagnostics({"slow_callback": report}),
+    )
+    watchdog.start()
+
+    def profile(seconds: str = ""):
+        try:
+            duration = max(0.1, min(float(seconds), 3600)) if seconds else conf["profile_seconds"]
+        except ValueError:
+            logger.warning(f"Invalid profile duration: {seconds}")
+            return
+        if not watchdog.profile(duration):
+            logger.warning("Profile is already running")
+
+    mqtt_client.add_diagnostics_command("profile", profile)
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profile)
+    except (AttributeError, NotImplementedError):
+        logger.debug("SIGUSR1 is not supported on this platform, profiling on signal disabled")
+
+    return watchdog
+
+
+async def _publish_metrics_loop(mqtt_client: MqttConnection, interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        mqtt_client.publish_diagnostics(registry.snapshot())
+
+
+class ConfigReloader:
+    """Applies changes of the configuration file to running services.
+
+    Poll coils and intervals, logging, retain flags, state filter and announce settings are applied in place while
+    connections and caches stay up. Other changes are reported and wait for a restart."""
+
+    RELOADABLE_MQTT = ("retain_state", "retain_availability", "state_filter", "announce")
+    RELOADABLE = {"logging", "nibe.poll", *(f"mqtt.{key}" for key in RELOADABLE_MQTT)}
+
+    def __init__(self, config_path: Path, services: list[Service]):
+        self._path = config_path
+        self._services = services
+        self._conf = services[0].conf
+        self._mtime = self._get_mtime()
+
+    def _get_mtime(self) -> float | None:
+        try:
+            return os.stat(self._path).st_mtime
+        except OSError:
+            return None
+
+    def reload(self):
+        try:
+            conf = cfg.load(self._path)
+        except Exception as e:
+            logger.error(f"Failed to reload configuration, keeping the running one: {e}")
+            return
+
+        changed = changed_keys(self._conf, conf)
+        polls = []
+        if "nibe" not in changed:
+            new_nibe = conf["nibe"] if isinstance(conf["nibe"], list) else [conf["nibe"]]
+            polls = [
+                (service, nibe_conf.get("poll"))
+                for service, nibe_conf in zip(self._services, new_nibe)
+                if service.nibe_conf.get("poll") != nibe_conf.get("poll")
+            ]
+        try:
+            for service, poll_conf in polls:
+                if poll_conf is not None:
+                    service.poller.resolve_coils(service.heatpump, poll_conf)
+        except CoilNotFoundException as e:
+            logger.error(f"Failed to reload configuration, keeping the running one: {e}")
+            return
+
+        restart = sorted(changed - self.RELOADABLE)
+        if restart:
+            logger.warning(f"Configuration changes of {', '.join(restart)} require a restart")
+
+        applied = sorted(changed & self.RELOADABLE)
+        if not applied:
+            logger.info("Configuration reloaded, nothing to apply")
+            return
+
+        if "logging" in applied:
+            self._conf["logging"] = conf["logging"]
+            root = logging.getLogger()
+            root.setLevel(conf["logging"]["level"])
+            for handler in root.handlers:
+                handler.setFormatter(logging.Formatter(conf["logging"]["format"]))
+
+        # Services and MQTT connection read these settings from the running config, update it in place
+        mqtt_conf = self._conf["mqtt"]
+        for key in self.RELOADABLE_MQTT:
+            if key in conf["mqtt"]:
+                mqtt_conf[key] = conf["mqtt"][key]
+            else:
+                mqtt_conf.pop(key, None)
+
+        if "mqtt.state_filter" in applied:
+            for service in self._services:
+                service.state_filter = StateFilter(mqtt_conf["state_filter"]) if "state_filter" in mqtt_conf else None
+
+        for service, poll_conf in polls:
+            service.poller.update_service(service, poll_conf)
+            service.nibe_conf["poll"] = poll_conf
+
+        logger.info(f"Configuration reloaded, applied changes of {', '.join(applied)}")
+
+    async def watch(self, interval: float):
+        """Reload whenever modification time of the configuration file changes."""
+        while True:
+            await asyncio.sleep(interval)
+            mtime = self._get_mtime()
+            if mtime != self._mtime:
+                self._mtime = mtime
+                self.reload()
+
+
+async def run_service(config_path: Path | str, log_version: str = None, watch_config: float = 0):
+    """Run the Nibe MQTT service with the given configuration file.
+
+    Configuration is reloaded on SIGHUP, and also when the file changes if `watch_config` interval is given."""
     conf = cfg.load(Path(config_path))
 
-    service = Service(conf)
+    services = create_services(conf)
 
     logging.basicConfig(**conf["logging"])
 
     if log_version:
         logging.info(log_version)
 
-    await service.start()
+    for service in services:
+        await service.start()
 
-    # Keep the service running indefinitely
+    if len(services) > 1:
+        await start_shared(conf, services[0].mqtt_client, services[0].poller)
+
+    reloader = ConfigReloader(Path(config_path), services)
+    stopped = asyncio.Event()
+    try:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, reloader.reload)
+        loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    except (AttributeError, NotImplementedError):
+        logger.debug("SIGHUP is not supported on this platform, config reload on signal disabled")
+    if watch_config:
+        asyncio.create_task(reloader.watch(watch_config))
+
+    # Keep the service running until SIGTERM or cancellation, then write out what is still buffered
     try:
-        await asyncio.Event().wait()
+        await stopped.wait()
     except KeyboardInterrupt:
         pass
+    finally:
+        for service in services:
+            service.stop()
+        services[0].mqtt_client.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+logger = logging.getLogger("nibe").getChild(__name__)
+
+
+def discovery_hash(payload: bytes) -> str:
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+
+class StateSnapshot:
+    """Last known state of each coil, kept on disk for warm restarts.
+
+    Changed entries are appended to a JSON lines file. The file is rewritten once superseded records outnumber
+    the live entries by `COMPACT_RATIO`."""
+
+    COMPACT_RATIO = 4
+
+    def __init__(self, path: Path):
+        self._path = path
+        self._entries: dict[str, dict] = {}
+        self._changes: dict[str, dict] = {}
+        self._lines = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name: str) -> dict:
+        return self._entries.get(name, {})
+
+    def items(self):
+        return self._entries.items()
+
+    def update(self, name: str, **fields):
+        self._entries.setdefault(name, {}).update(fields)
+        self._changes.setdefault(name, {}).update(fields)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._changes)
+
+    def load(self):
+        if not self._path.is_file():
+            return
+
+        try:
+            with self._path.open("r", encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line may be truncated if the process died while appending
+                        logger.warning(f"Skipping malformed record in state snapshot {self._path}")
+                        continue
+                    self._entries.setdefault(record.pop("name"), {}).update(record)
+                    self._lines += 1
+        except OSError as e:
+            logger.warning(f"Failed to load state snapshot {self._path}: {e}")
+            return
+
+        logger.info(f"Loaded {len(self._entries)} coils from state snapshot {self._path}")
+
+    def dump(self) -> tuple[list[dict], bool]:
+        """Take pending changes. Returns records to write and whether they replace the whole file."""
+        compact = self._lines + len(self._changes) > self.COMPACT_RATIO * len(self._entries)
+        source = self._entries if compact else self._changes
+        records = [{"name": name, **fields} for name, fields in source.items()]
+
+        self._lines = len(records) if compact else self._lines + len(records)
+        self._changes = {}
+        return records, compact
+
+    def write(self, records: list[dict], compact: bool):
+        try:
+            if compact:
+                tmp = self._path.with_suffix(self._path.suffix + ".tmp")
+                with tmp.open("w", encoding="utf-8") as fh:
+                    fh.writelines(json.dumps(record, default=str) + "\n" for record in records)
+                os.replace(tmp, self._path)
+            else:
+                with self._path.open("a", encoding="utf-8") as fh:
+                    fh.writelines(json.dumps(record, default=str) + "\n" for record in records)
+        except OSError as e:
+            logger.warning(f"Failed to write state snapshot {self._path}: {e}")
+
+    def save(self):
+        self.write(*self.dump())
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+from collections import deque
+
+from nibe.coil import Coil
+
+from nibe_mqtt.filter import _is_number
+
+STATISTICS = ("min", "mean", "max")
+
+
+def window_label(seconds: int) -> str:
+    return f"{seconds // 60}m" if seconds % 60 == 0 else f"{seconds}s"
+
+
+class _Bucket:
+    __slots__ = ("min", "max", "sum", "count", "last")
+
+    def __init__(self, value: float):
+        self.min = self.max = self.sum = self.last = value
+        self.count = 1
+
+    def add(self, value: float):
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sum += value
+        self.count += 1
+        self.last = value
+
+
+class StatisticsAggregator:
+    """Downsamples numeric coil values into min/mean/max/last over sliding windows.
+
+    Values are collected into buckets as long as the shortest window. Each coil keeps a ring of the buckets covering
+    its longest window, so memory per coil stays fixed however often the coil is updated."""
+
+    def __init__(self, conf: dict):
+        self._coils = {}
+        for item in conf["coils"]:
+            if isinstance(item, dict):
+                self._coils[item["coil"]] = {"raw": item["raw"]}
+            else:
+                self._coils[item] = {"raw": True}
+        self.windows = sorted(conf["windows"])
+        self.bucket_seconds = self.windows[0]
+        self._ring_size = self.windows[-1] // self.bucket_seconds
+
+        self._coil_conf: dict[Coil, dict | None] = {}
+        self._current: dict[Coil, _Bucket] = {}
+        self._rings: dict[Coil, deque] = {}
+
+    @property
+    def labels(self) -> list[str]:
+        return [window_label(window) for window in self.windows]
+
+    def _get_coil_conf(self, coil: Coil) -> dict | None:
+        if coil not in self._coil_conf:
+            self._coil_conf[coil] = self._coils.get(coil.name, self._coils.get(coil.address))
+
+        return self._coil_conf[coil]
+
+    def is_tracked(self, coil: Coil) -> bool:
+        return self._get_coil_conf(coil) is not None
+
+    def publishes_raw(self, coil: Coil) -> bool:
+        coil_conf = self._get_coil_conf(coil)
+        return coil_conf is None or coil_conf["raw"]
+
+    def add(self, coil: Coil, value):
+        if not _is_number(value) or not self.is_tracked(coil):
+            return
+
+        bucket = self._current.get(coil)
+        if bucket is None:
+            self._current[coil] = _Bucket(value)
+        else:
+            bucket.add(value)
+
+        if coil not in self._rings:
+            self._rings[coil] = deque(maxlen=self._ring_size)
+
+    def roll(self) -> dict[Coil, dict]:
+        """Close the current bucket of every coil and return statistics of coils with values in any window."""
+        statistics = {}
+        for coil, ring in self._rings.items():
+            ring.append(self._current.pop(coil, None))
+
+            coil_statistics = {}
+            for window in self.windows:
+                size = window // self.bucket_seconds
+                buckets = [bucket for bucket in list(ring)[-size:] if bucket is not None]
+                if buckets:
+                    count = sum(bucket.count for bucket in buckets)
+                    coil_statistics[window_label(window)] = {
+                        "min": min(bucket.min for bucket in buckets),
+                        "mean": round(sum(bucket.sum for bucket in buckets) / count, 3),
+                        "max": max(bucket.max for bucket in buckets),
+                        "last": buckets[-1].last,
+                        "count": count,
+                    }
+            if coil_statistics:
+                statistics[coil] = coil_statistics
+
+        return statistics
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from types import FrameType
+from typing import Callable
+
+from nibe.coil import Coil, CoilData
+
+from nibe_mqtt.metrics import registry
+
+logger = logging.getLogger("nibe").getChild(__name__)
+
+loop_lag_seconds = registry.histogram(
+    "nibe_mqtt_loop_lag_seconds", "Time a callback scheduled by the watchdog waited to run", (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+)
+slow_callbacks = registry.counter("nibe_mqtt_slow_callbacks_total", "Times the event loop was blocked longer than the watchdog threshold")
+
+STACK_DEPTH = 8
+
+
+def _involved(frame: FrameType | None) -> str | None:
+    """Coil or MQTT topic the innermost frame that has one in its locals was working on."""
+    while frame is not None:
+        local = frame.f_locals
+        for name in ("coil_data", "coil", "msg", "topic"):
+            value = local.get(name)
+            if isinstance(value, CoilData):
+                return f"coil {value.coil.name}"
+            if isinstance(value, Coil):
+                return f"coil {value.name}"
+            if isinstance(getattr(value, "topic", None), str):
+                return f"topic {value.topic}"
+            if name == "topic" and isinstance(value, str):
+                return f"topic {value}"
+        frame = frame.f_back
+
+    return None
+
+
+def _fold(frame: FrameType) -> str:
+    """Stack in collapsed format, outermost frame first, as used by flame graph tools."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+class LoopWatchdog:
+    """Watches event loop health from a separate thread.
+
+    Twice per `threshold` the watchdog thread schedules a callback on the loop and records how long it waited to run
+    as loop lag. When it waits longer than `threshold`, the thread captures what the loop thread is executing together
+    with the coil or topic involved, which is logged and handed to `on_slow` once the loop is responsive again.
+
+    `profile` samples the loop thread stack every `sample_interval` seconds and writes the collapsed stacks to a file
+    that flame graph tools like speedscope or flamegraph.pl read."""
+
+    def __init__(
+        self,
+        threshold: float = 0.1,
+        sample_interval: float = 0.005,
+        profile_dir: Path = Path("."),
+        on_slow: Callable[[dict], None] | None = None,
+    ):
+        self.threshold = threshold
+        self.sample_interval = sample_interval
+        self.profile_dir = profile_dir
+        self.on_slow = on_slow
+
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: int | None = None
+        self._stopped = threading.Event()
+        self._profiling = False
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        threading.Thread(target=self._watch, name="nibe-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 2):
+            sent = time.monotonic()
+            answered = threading.Event()
+            try:
+                self._loop.call_soon_threadsafe(answered.set)
+            except RuntimeError:
+                return  # loop is closed
+
+            stall = None
+            if not answered.wait(self.threshold):
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    stall = (traceback.format_stack(frame)[-STACK_DEPTH:], _involved(frame))
+                while not answered.wait(self.threshold):
+                    if self._stopped.is_set():
+                        return
+
+            lag = time.monotonic() - sent
+            try:
+                self._loop.call_soon_threadsafe(self._record, lag, stall)
+            except RuntimeError:
+                return
+
+    def _record(self, lag: float, stall: tuple[list[str], str | None] | None):
+        loop_lag_seconds.observe(lag)
+        if lag >= self.threshold:
+            self._report(lag, stall)
+
+    def _report(self, lag: float, stall: tuple[list[str], str | None] | None):
+        slow_callbacks.inc()
+        report = {"lag": round(lag, 3)}
+        if stall is not None:
+            stack, involved = stall
+            report["stack"] = [line.strip() for line in stack]
+            if involved is not None:
+                report["involved"] = involved
+
+        message = f"Event loop was blocked for {lag:.3f}s"
+        if "involved" in report:
+            message += f" handling {report['involved']}"
+        if stall is not None:
+            message += ":\n" + "".join(stall[0])
+        logger.warning(message)
+
+        if self.on_slow is not None:
+            self.on_slow(report)
+
+    def profile(self, seconds: float) -> bool:
+        """Start a sampling profile of the loop thread in the background. Returns False if one is already running."""
+        if self._profiling or self._loop_thread is None:
+            return False
+
+        self._profiling = True
+        logger.warning(f"Profiling event loop for {seconds}s")
+        threading.Thread(target=self._profile, args=(seconds,), name="nibe-profiler", daemon=True).start()
+        return True
+
+    def _profile(self, seconds: float):
+        try:
+            stacks = collections.Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    stacks[_fold(frame)] += 1
+                time.sleep(self.sample_interval)
+
+            path = self.write_profile(stacks)
+            logger.warning(f"Wrote {sum(stacks.values())} samples to {path}")
+        except OSError as e:
+            logger.error(f"Failed to write profile: {e}")
+        finally:
+            self._profiling = False
+
+    def write_profile(self, stacks: collections.Counter) -> Path:
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        path = self.profile_dir / f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        with path.open("w", encoding="utf-8") as fh:
+            for stack, count in stacks.most_common():
+                fh.write(f"{stack} {count}\n")
+
+        return path
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable
+from typing import Callable
+
+from nibe.coil import Coil, CoilData
+
+from nibe_mqtt.metrics import registry
+from nibe_mqtt.reader import CoilReader
+
+logger = logging.getLogger("nibe").getChild(__name__)
+
+set_to_confirmed_seconds = registry.histogram("nibe_mqtt_set_to_confirmed_seconds", "Time from MQTT set command to confirmed coil value")
+readback_failures = registry.counter("nibe_mqtt_readback_failures_total", "Coil read-backs after write that failed")
+readbacks_skipped = registry.counter("nibe_mqtt_readbacks_skipped_total", "Writes confirmed by a coil update without a read-back")
+
+
+def _matches(coil: Coil, written, value) -> bool:
+    if value is None:
+        return False
+    if isinstance(written, str) or isinstance(value, str):
+        return str(written).upper() == str(value).upper()
+
+    # The pump rounds written numbers to the coil resolution
+    return round(written * coil.factor) == round(value * coil.factor)
+
+
+class WriteQueue:
+    """Serializes writes per coil, keeping only the latest pending value.
+
+    A successful write is confirmed by the first update of the coil showing the written value, pushed by the pump or
+    polled, within the read-back delay. Coils still unconfirmed then are read back together with a single batched
+    read. Failed writes are not read back. The outcome of every command is reported to `on_status`."""
+
+    def __init__(
+        self,
+        write_coil: Callable[[CoilData], Awaitable[bool]],
+        reader: CoilReader,
+        concurrency: int,
+        readback_delay: float,
+        on_status: Callable[[Coil, dict], None] | None = None,
+    ):
+        self._write_coil = write_coil
+        self._reader = reader
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._readback_delay = readback_delay
+        self._on_status = on_status
+
+        self._pending: dict[Coil, CoilData] = {}
+        self._active: set[Coil] = set()
+        self._written: dict[Coil, CoilData] = {}
+        self._observed: dict[Coil, object] = {}
+        self._readback: set[Coil] = set()
+        self._reading: set[Coil] = set()
+        self._readback_task = None
+        self._submitted: dict[Coil, float] = {}
+
+    def submit(self, coil_data: CoilData):
+        coil = coil_data.coil
+        self._submitted.setdefault(coil, time.monotonic())
+        if coil in self._pending:
+            logger.debug(f"Replacing pending write of {coil.name}: {self._pending[coil].value} -> {coil_data.value}")
+        self._pending[coil] = coil_data
+
+        if coil not in self._active:
+            self._active.add(coil)
+            asyncio.create_task(self._drain(coil))
+
+    async def _drain(self, coil: Coil):
+        try:
+            while coil in self._pending:
+                async with self._semaphore:
+                    coil_data = self._pending.pop(coil)
+                    written = await self._write_coil(coil_data)
+        finally:
+            self._active.discard(coil)
+
+        if not written:
+            self._written.pop(coil, None)
+            self._readback.discard(coil)
+            self._finish(coil_data, "failed")
+            return
+
+        self._written[coil] = coil_data
+        self._observed.pop(coil, None)
+        self._schedule_readback(coil)
+
+    def on_coil_update(self, coil_data: CoilData):
+        """Confirm a written coil from any update of it, so that it does not need a read-back."""
+        coil = coil_data.coil
+        written = self._written.get(coil)
+        if written is None or coil in self._active:
+            return
+
+        if not _matches(coil, written.value, coil_data.value):
+            self._observed[coil] = coil_data.value  # may be a stale push, wait for a matching value or the read-back
+            return
+
+        del self._written[coil]
+        if coil in self._reading:
+            self._finish(written, "confirmed", via="readback")
+        else:
+            self._readback.discard(coil)
+            readbacks_skipped.inc()
+            self._finish(written, "confirmed", via="update")
+
+    def _schedule_readback(self, coil: Coil):
+        self._readback.add(coil)
+        if self._readback_task is None:
+            self._readback_task = asyncio.create_task(self._readback_later())
+
+    async def _readback_later(self):
+        await asyncio.sleep(self._readback_delay)
+
+        # Coils confirmed by an update meanwhile are no longer in the set
+        coils = list(self._readback)
+        self._readback.clear()
+        self._readback_task = None
+        if not coils:
+            return
+
+        self._reading.update(coils)
+        try:
+            failures = await self._reader.read_coils(coils)
+        finally:
+            self._reading.difference_update(coils)
+        for coil, e in failures:
+            logger.error(f"Read-back of {coil.name} failed: {e}")
+        readback_failures.inc(len(failures))
+
+        failed = {coil for coil, _ in failures}
+        for coil in coils:
+            if coil in self._readback or coil in self._active:
+                continue  # written again meanwhile, confirmed with the next write
+            written = self._written.pop(coil, None)
+            if written is None:
+                continue  # confirmed by the read-back
+
+            if coil in failed:
+                self._finish(written, "unconfirmed", via="readback")
+            else:
+                logger.warning(f"Read-back of {coil.name} shows {self._observed.get(coil)} instead of written {written.value}")
+                self._finish(written, "mismatch", via="readback", actual=self._observed.get(coil))
+
+    def _finish(self, coil_data: CoilData, state: str, **extra):
+        coil = coil_data.coil
+        self._observed.pop(coil, None)
+        submitted = self._submitted.pop(coil, None)
+        latency = None if submitted is None else time.monotonic() - submitted
+        if state == "confirmed" and latency is not None:
+            set_to_confirmed_seconds.observe(latency)
+
+        if self._on_status is not None:
+            self._on_status(coil, {"value": coil_data.value, "state": state, "latency": None if latency is None else round(latency, 3), **extra})
@@ -0,0 +1,15 @@
+from __future__ import annotations
+
+import pytest
+from nibe.coil import Coil
+
+
+def _make_coil(address: int = 40004, name: str | None = None, size: str = "s16", factor: int = 10, **kwargs) -> Coil:
+    name = name or f"coil-{address}"
+    return Coil(address=address, name=name, title=name, size=size, factor=factor, **kwargs)
+
+
+@pytest.fixture
+def make_coil():
+    """Factory of plain coils named after their address unless a name is given."""
+    return _make_coil
@@ -0,0 +1,32 @@
+from __future__ import annotations
+
+import pytest
+
+from nibe_mqtt.adaptive import AdaptiveInterval
+
+
+def test_stable_value_backs_off_and_change_snaps_back():
+    adaptive = AdaptiveInterval(60, max_interval=300, backoff=2)
+
+    intervals = []
+    for now in range(0, 600, 60):
+        adaptive.update(20.5, now, pushed=False)
+        intervals.append(adaptive.next_poll(now))
+    assert intervals == [60, 120, 240, 300, 300, 300, 300, 300, 300, 300]
+
+    adaptive.update(21.0, 600, pushed=False)
+    assert adaptive.next_poll(600) == 60
+
+
+def test_pushed_coil_is_polled_only_when_pushes_stop():
+    adaptive = AdaptiveInterval(60, max_interval=300, backoff=2)
+
+    for now in (0, 70, 140, 210):
+        adaptive.update(1, now, pushed=True)
+    assert adaptive.push_period == pytest.approx(70)
+    assert adaptive.is_push_covered(210)
+    assert adaptive.next_poll(210) == pytest.approx(140)
+
+    assert not adaptive.is_push_covered(400)
+    adaptive.update(1, 400, pushed=False)
+    assert adaptive.next_poll(400) == 120
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+from nibe_mqtt.arbiter import BusArbiter, Priority
+
+
+async def test_writes_are_served_before_readbacks_and_polls():
+    arbiter = BusArbiter(concurrency=1)
+    order = []
+
+    async def request(name):
+        order.append(name)
+        await asyncio.sleep(0.01)
+
+    busy = asyncio.create_task(arbiter.run(Priority.POLL, request, "first poll"))
+    await asyncio.sleep(0)
+    queued = [
+        asyncio.create_task(arbiter.run(Priority.POLL, request, "poll")),
+        asyncio.create_task(arbiter.run(Priority.READBACK, request, "readback")),
+        asyncio.create_task(arbiter.run(Priority.WRITE, request, "write")),
+    ]
+    await asyncio.gather(busy, *queued)
+
+    assert order == ["first poll", "write", "readback", "poll"]
+
+
+async def test_duplicate_reads_are_joined_and_rate_is_limited(make_coil):
+    arbiter = BusArbiter(concurrency=2, rate=20)
+    reads = []
+
+    async def read_coil(coil):
+        reads.append(coil.address)
+        return coil.address
+
+    coils = {address: make_coil(address) for address in (1, 2, 3)}
+    start = time.monotonic()
+    results = await asyncio.gather(*(arbiter.read(coils[address], read_coil, Priority.POLL) for address in (1, 2, 1, 3, 2)))
+
+    assert results == [1, 2, 1, 3, 2]
+    assert sorted(reads) == [1, 2, 3]
+    assert time.monotonic() - start >= 0.09
@@ -0,0 +1,18 @@
+from __future__ import annotations
+
+from argparse import Namespace
+
+from benchmarks.bench_service import run
+
+
+async def test_benchmarks_run():
+    args = Namespace(updates=50, coils=10, rate=1000, duration=0.01, latency=0, bus_slots=1, concurrency=2, model="F1255", seed=0)
+
+    results = await run(args)
+
+    assert results["update_throughput"]["publishes"] >= 50
+    assert results["publish_path"]["update_us"] > 0
+    assert results["aggregate_only"]["messages"] < results["aggregate_per_coil"]["messages"]
+    assert results["poll_sweep"]["reads"] == 10
+    assert results["poll_sweep_batch"]["reads"] == 10
+    assert results["startup_lazy"]["retained_kib"] < results["startup"]["retained_kib"]
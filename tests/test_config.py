@@ -1,6 +1,12 @@
 from __future__ import annotations
 
-from nibe_mqtt.config import schema
+import json
+from unittest import mock
+
+import pytest
+from voluptuous import Invalid
+
+from nibe_mqtt.config import Config, schema
 
 
 def test_nibegw():
@@ -37,3 +43,77 @@ def test_modbus():
     assert config["nibe"]["poll"]["interval"] == 60
 
     print(config)
+
+
+def test_poll_per_coil_interval():
+    config = schema(
+        {
+            "mqtt": {"host": "192.168.1.2"},
+            "nibe": {
+                "nibegw": {"ip": "192.168.1.3"},
+                "model": "F1255",
+                "poll": {"coils": ["bt50-room-temp-s1-40033", {"coil": "bt1-outdoor-temperature-40004", "interval": 10}, {"coil": 40014}]},
+            },
+        }
+    )
+
+    assert config["nibe"]["poll"]["coils"][1] == {"coil": "bt1-outdoor-temperature-40004", "interval": 10}
+    assert config["nibe"]["poll"]["batch"] is False
+
+
+def test_multiple_heatpumps():
+    heatpump = {"nibegw": {"ip": "192.168.1.3"}, "model": "F1255"}
+    config = schema(
+        {
+            "mqtt": {"host": "192.168.1.2"},
+            "nibe": [{**heatpump, "prefix": "nibe/house"}, {**heatpump, "prefix": "nibe/garage"}],
+        }
+    )
+
+    assert [heatpump["prefix"] for heatpump in config["nibe"]] == ["nibe/house", "nibe/garage"]
+
+    for nibe in ([heatpump, {**heatpump, "prefix": "nibe/garage"}], [{**heatpump, "prefix": "nibe/a"}, {**heatpump, "prefix": "nibe/a"}]):
+        with pytest.raises(Invalid):
+            schema({"mqtt": {"host": "192.168.1.2"}, "nibe": nibe})
+
+
+def test_config_cache_keyed_by_content(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text("mqtt:\n  host: 192.168.1.2\nnibe:\n  model: F1255\n  nibegw:\n    ip: 192.168.1.3\n")
+
+    loaded = Config().load(config_file)
+    assert (tmp_path / ".config.yaml.cache").is_file()
+
+    with mock.patch("nibe_mqtt.config.schema", side_effect=AssertionError("cache not used")):
+        assert Config().load(config_file) == loaded
+
+    cache = json.loads((tmp_path / ".config.yaml.cache").read_text())
+    assert cache["data"]["nibe"]["model"] == "F1255"
+
+    config_file.write_text(config_file.read_text().replace("F1255", "S1255"))
+    assert Config().load(config_file)["nibe"]["model"].name == "S1255"
+
+
+def test_cached_config_equals_fresh_load(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        "mqtt:\n  host: 192.168.1.2\n  state_filter:\n    coils:\n      40013:\n        heartbeat: 0\n"
+        "nibe:\n  model: F1255\n  nibegw:\n    ip: 192.168.1.3\n"
+    )
+
+    fresh = Config().load(config_file)
+    cached = Config().load(config_file)
+
+    assert cached == fresh
+    assert cached["mqtt"]["state_filter"]["coils"] == {"40013": {"heartbeat": 0}}
+
+
+def test_config_cache_invalidated_by_nibe_version(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text("mqtt:\n  host: 192.168.1.2\nnibe:\n  model: F1255\n  nibegw:\n    ip: 192.168.1.3\n")
+    Config().load(config_file)
+
+    with mock.patch("nibe.__version__", "0.0.0"), mock.patch("nibe_mqtt.config.schema", wraps=schema) as validate:
+        Config().load(config_file)
+
+    validate.assert_called_once()
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+from unittest import mock
+
+from nibe.coil import CoilData
+
+from nibe_mqtt.config import schema
+from nibe_mqtt.filter import StateFilter
+
+
+def _filter(**state_filter):
+    config = schema({"mqtt": {"host": "127.0.0.1", "state_filter": state_filter}, "nibe": {"nibegw": {"ip": "127.0.0.1"}, "model": "F1255"}})
+    return StateFilter(config["mqtt"]["state_filter"])
+
+
+def test_unchanged_value_is_suppressed_until_heartbeat(make_coil):
+    state_filter = _filter(heartbeat=60)
+    coil = make_coil(factor=1, mappings={"0": "OFF", "1": "ON"})
+
+    with mock.patch("time.monotonic", return_value=100):
+        assert state_filter.should_publish(CoilData(coil, "ON"))
+        assert not state_filter.should_publish(CoilData(coil, "ON"))
+        assert state_filter.should_publish(CoilData(coil, "OFF"))
+    with mock.patch("time.monotonic", return_value=160):
+        assert state_filter.should_publish(CoilData(coil, "OFF"))
+
+
+def test_zero_heartbeat_never_republishes_unchanged_value(make_coil):
+    state_filter = _filter(heartbeat=0)
+    coil = make_coil()
+
+    with mock.patch("time.monotonic", return_value=100):
+        assert state_filter.should_publish(CoilData(coil, 1))
+    with mock.patch("time.monotonic", return_value=100000):
+        assert not state_filter.should_publish(CoilData(coil, 1))
+        assert state_filter.should_publish(CoilData(coil, 2))
+
+
+def test_numeric_deadband_with_per_coil_override(make_coil):
+    state_filter = _filter(absolute=0.5, coils={"coil-40005": {"relative": 0.1}, 40006: {"absolute": 0}})
+    outdoor = make_coil(40004)
+    counter = make_coil(40005)
+    exact = make_coil(40006)
+
+    assert state_filter.should_publish(CoilData(outdoor, 10.0))
+    assert not state_filter.should_publish(CoilData(outdoor, 10.3))
+    assert not state_filter.should_publish(CoilData(outdoor, 9.5))
+    assert state_filter.should_publish(CoilData(outdoor, 10.6))
+
+    assert state_filter.should_publish(CoilData(counter, 100))
+    assert not state_filter.should_publish(CoilData(counter, 110))
+    assert state_filter.should_publish(CoilData(counter, 111))
+
+    assert state_filter.should_publish(CoilData(exact, 1.0))
+    assert state_filter.should_publish(CoilData(exact, 1.1))
+
+    state_filter.clear()
+    assert state_filter.should_publish(CoilData(outdoor, 10.6))
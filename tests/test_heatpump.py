@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+import pytest
+from nibe.exceptions import CoilNotFoundException
+from nibe.heatpump import HeatPump, Model
+
+from nibe_mqtt.heatpump import LazyHeatPump
+
+
+async def test_lazy_heatpump_builds_coils_on_lookup():
+    heatpump = LazyHeatPump(Model.F1255)
+    await heatpump.initialize()
+    assert heatpump.loaded_coils == 0
+
+    outdoor = heatpump.get_coil_by_address(40004)
+    assert heatpump.get_coil_by_name(outdoor.name) is outdoor
+    assert heatpump.get_coil_by_address("40004") is outdoor
+    assert heatpump.loaded_coils == 1
+
+    with pytest.raises(CoilNotFoundException):
+        heatpump.get_coil_by_name("no-such-coil")
+
+    eager = HeatPump(Model.F1255)
+    await eager.initialize()
+    writable = heatpump.get_writable_coil_names()
+    assert writable == {coil.name for coil in eager.get_coils() if coil.is_writable}
+    assert heatpump.loaded_coils == 1
+    assert [coil.name for coil in heatpump.get_coils()] == [coil.name for coil in eager.get_coils()]
+    assert heatpump.get_coil_by_address(40004) is outdoor
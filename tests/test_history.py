@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import csv
+
+from nibe.coil import Coil
+
+from nibe_mqtt.console_scripts import nibe_mqtt_history
+from nibe_mqtt.history import HistorySink, read_samples
+
+MIDNIGHT = 1767225600.0  # 2026-01-01T00:00:00Z
+
+
+def test_samples_are_written_per_day_and_read_back(tmp_path):
+    outdoor = Coil(address=40004, name="bt1-outdoor-temperature-40004", title="BT1", size="s16", factor=10)
+    mode = Coil(address=47137, name="op-mode-47137", title="Op mode", size="u8", mappings={"0": "AUTO", "1": "MANUAL"})
+    sink = HistorySink(tmp_path)
+
+    sink.add(outdoor, -1.5, now=MIDNIGHT - 10.25)
+    sink.add(mode, "MANUAL", now=MIDNIGHT - 5)
+    sink.add(mode, "NOT MAPPED", now=MIDNIGHT - 4)
+    sink.add(outdoor, None, now=MIDNIGHT - 3)
+    sink.add(outdoor, -2.0, now=MIDNIGHT + 1)
+    assert len(sink) == 3
+    sink.save()
+    sink.add(outdoor, -2.5, now=MIDNIGHT + 61)
+    sink.save()
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["2025-12-31.nbh", "2026-01-01.nbh"]
+    assert list(read_samples(tmp_path, MIDNIGHT - 3600, MIDNIGHT + 3600)) == [
+        (MIDNIGHT - 10.25, 40004, -1.5),
+        (MIDNIGHT - 5, 47137, 1.0),
+        (MIDNIGHT + 1, 40004, -2.0),
+        (MIDNIGHT + 61, 40004, -2.5),
+    ]
+    assert list(read_samples(tmp_path, MIDNIGHT, MIDNIGHT + 60)) == [(MIDNIGHT + 1, 40004, -2.0)]
+
+    with (tmp_path / "2026-01-01.nbh").open("ab") as fh:
+        fh.write(b"NBH1\x05")
+    assert len(list(read_samples(tmp_path, MIDNIGHT, MIDNIGHT + 3600))) == 2
+
+
+def test_export_writes_csv_with_coil_names_and_mapped_values(tmp_path, monkeypatch):
+    history = tmp_path / "history"
+    config = tmp_path / "config.yaml"
+    config.write_text(f"mqtt:\n  host: 127.0.0.1\nnibe:\n  model: F1255\n  nibegw:\n    ip: 127.0.0.1\n  history:\n    path: {history}\n")
+    sink = HistorySink(history)
+    sink.add(Coil(address=40004, name="bt1-outdoor-temperature-40004", title="BT1", size="s16", factor=10), 3.5, now=MIDNIGHT + 1)
+    sink.add(Coil(address=43009, name="calc-supply-s1-43009", title="Calc", size="s16", factor=10), 30.0, now=MIDNIGHT + 2)
+    sink.save()
+
+    output = tmp_path / "out.csv"
+    monkeypatch.setattr(nibe_mqtt_history.sys, "exit", lambda code: None)
+    nibe_mqtt_history.main(["-c", str(config), "export", "--start", "2026-01-01T00:00+00:00", "--end", "2026-01-02T00:00+00:00", "-o", str(output)])
+
+    with output.open() as fh:
+        rows = list(csv.reader(fh))
+    assert rows == [
+        ["time", "address", "name", "value"],
+        ["2026-01-01T00:00:01.000+00:00", "40004", "bt1-outdoor-temperature-40004", "3.5"],
+        ["2026-01-01T00:00:02.000+00:00", "43009", "calc-supply-s1-43009", "30"],
+    ]
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import asyncio
+
+from nibe_mqtt.metrics import MetricsServer, Registry
+
+
+def test_render_prometheus_text():
+    registry = Registry()
+    updates = registry.counter("nibe_mqtt_coil_updates_total", "Coil updates")
+    sweep = registry.histogram("nibe_mqtt_poll_sweep_seconds", "Poll sweep", buckets=(0.1, 1.0))
+    registry.gauge("nibe_mqtt_outbox_depth", "Outbox depth", lambda: 7)
+
+    updates.inc()
+    updates.inc(2)
+    sweep.observe(0.05)
+    sweep.observe(0.5)
+    sweep.observe(3)
+
+    assert registry.render().splitlines() == [
+        "# HELP nibe_mqtt_coil_updates_total Coil updates",
+        "# TYPE nibe_mqtt_coil_updates_total counter",
+        "nibe_mqtt_coil_updates_total 3",
+        "# HELP nibe_mqtt_poll_sweep_seconds Poll sweep",
+        "# TYPE nibe_mqtt_poll_sweep_seconds histogram",
+        'nibe_mqtt_poll_sweep_seconds_bucket{le="0.1"} 1',
+        'nibe_mqtt_poll_sweep_seconds_bucket{le="1.0"} 2',
+        'nibe_mqtt_poll_sweep_seconds_bucket{le="+Inf"} 3',
+        "nibe_mqtt_poll_sweep_seconds_sum 3.55",
+        "nibe_mqtt_poll_sweep_seconds_count 3",
+        "# HELP nibe_mqtt_outbox_depth Outbox depth",
+        "# TYPE nibe_mqtt_outbox_depth gauge",
+        "nibe_mqtt_outbox_depth 7",
+    ]
+    assert registry.snapshot() == {
+        "nibe_mqtt_coil_updates_total": 3,
+        "nibe_mqtt_poll_sweep_seconds": {"count": 3, "sum": 3.55, "max": 3},
+        "nibe_mqtt_outbox_depth": 7,
+    }
+
+
+async def test_metrics_server_serves_registry():
+    registry = Registry()
+    registry.counter("nibe_mqtt_coil_updates_total", "Coil updates").inc()
+    server = MetricsServer(registry, "127.0.0.1", 0)
+    await server.start()
+    port = server._server.sockets[0].getsockname()[1]
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    response = await reader.read()
+    writer.close()
+    await server.stop()
+
+    assert response.startswith(b"HTTP/1.0 200 OK")
+    assert b"nibe_mqtt_coil_updates_total 1\n" in response
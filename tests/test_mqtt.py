@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import socket
+import threading
+from unittest import mock
+
+import pytest
+from nibe.coil import Coil, CoilData
+from paho.mqtt.client import MQTTErrorCode
+
+from nibe_mqtt.config import schema
+from nibe_mqtt.mqtt import MqttConnection
+
+
+class FakeBroker:
+    """Just enough of an MQTT 3.1.1 broker to accept a client, record its publishes and drop its connection."""
+
+    def __init__(self):
+        self.connects = 0
+        self.published: list[tuple[str, bytes]] = []
+        self._writers: list[asyncio.StreamWriter] = []
+        self._server = None
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    def drop_clients(self):
+        for writer in self._writers:
+            writer.close()
+        self._writers.clear()
+
+    async def close(self):
+        self.drop_clients()
+        self._server.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.append(writer)
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+
+                kind = header >> 4
+                if kind == 1:  # CONNECT
+                    self.connects += 1
+                    writer.write(b"\x20\x02\x00\x00")
+                elif kind == 3:  # PUBLISH, QoS 0
+                    topic_end = 2 + int.from_bytes(body[:2], "big")
+                    self.published.append((body[2:topic_end].decode(), body[topic_end:]))
+                elif kind == 8:  # SUBSCRIBE, one topic filter per request
+                    writer.write(b"\x90\x03" + body[:2] + b"\x00")
+                elif kind == 12:  # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif kind == 14:  # DISCONNECT
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _wait_for(predicate, timeout: float = 10.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.05)
+
+
+@pytest.fixture
+def mqtt_connection():
+    config = schema({"mqtt": {"host": "127.0.0.1"}, "nibe": {"nibegw": {"ip": "127.0.0.1"}, "model": "F1255"}})
+    connection = MqttConnection(mock.Mock(), config["mqtt"])
+    connection._client = mock.Mock()
+    return connection
+
+
+DEVICE_INFO = {"model": "F1255", "name": "Nibe heatpump integration", "id": "nibe-127-0-0-1"}
+
+
+def test_discovery_payload_is_cached_until_invalidated(mqtt_connection):
+    coil = Coil(address=47137, name="op-mode-47137", title="Op mode", size="u8", write=True, mappings={"0": "AUTO", "1": "MANUAL", "2": "ADD"})
+
+    with mock.patch("nibe_mqtt.mqtt.json.dumps", wraps=json.dumps) as dumps:
+        mqtt_connection.publish_discovery(coil, DEVICE_INFO)
+        mqtt_connection.publish_discovery(coil, DEVICE_INFO)
+        assert dumps.call_count == 1
+
+        topic, payload = mqtt_connection._client.publish.call_args.args
+        assert topic == "homeassistant/select/nibe-127-0-0-1/op-mode-47137/config"
+        assert json.loads(payload)["options"] == ["AUTO", "MANUAL", "ADD"]
+
+        coil.set_mappings({**coil.mappings, "3": "UNKNOWN (3)"})
+        mqtt_connection.invalidate_discovery(coil)
+        mqtt_connection.publish_discovery(coil, DEVICE_INFO)
+        assert dumps.call_count == 2
+
+    topic, payload = mqtt_connection._client.publish.call_args.args
+    assert json.loads(payload)["options"] == ["AUTO", "MANUAL", "ADD", "UNKNOWN (3)"]
+
+
+def test_published_topics_and_mapped_payloads_are_reused(mqtt_connection):
+    mqtt_connection._connected = True
+    mqtt_connection._loop = mock.Mock()
+    coil = Coil(address=47137, name="op-mode-47137", title="Op mode", size="u8", write=True, mappings={"0": "AUTO", "1": "MANUAL"})
+
+    mqtt_connection.publish_coil_state(CoilData(coil, "MANUAL"))
+    mqtt_connection.publish_coil_state(CoilData(coil, "MANUAL"))
+
+    first, second = mqtt_connection._client.publish.call_args_list
+    assert first.args == ("nibe/coils/op-mode-47137", b"MANUAL")
+    assert first.args[0] is second.args[0] and first.args[1] is second.args[1]
+
+    mqtt_connection._on_message_cb(None, None, mock.Mock(topic="nibe/coils/op-mode-47137/set", payload=b"AUTO", retain=False))
+    assert mqtt_connection._set_topics["nibe/coils/op-mode-47137/set"] == ("nibe", "op-mode-47137")
+    mqtt_connection._loop.call_soon_threadsafe.assert_called_once()
+    assert mqtt_connection._loop.call_soon_threadsafe.call_args.args[1:] == ("op-mode-47137", "AUTO")
+
+
+def test_commands_are_rejected_before_reaching_the_event_loop(mqtt_connection):
+    from nibe_mqtt.mqtt import commands_dropped
+
+    mqtt_connection._loop = mock.Mock()
+    mqtt_connection.set_writable_coils("nibe", frozenset({"op-mode-47137"}))
+    dropped = {reason: counter.value for reason, counter in commands_dropped.items()}
+
+    def send(name, payload, retain=False):
+        mqtt_connection._on_message_cb(None, None, mock.Mock(topic=f"nibe/coils/{name}/set", payload=payload, retain=retain))
+
+    send("op-mode-47137", b"AUTO", retain=True)
+    send("no-such-coil", b"AUTO")
+    send("op-mode-47137", b"\xff")
+    send("op-mode-47137", b"")
+    for _ in range(10):
+        send("op-mode-47137", b"AUTO")
+
+    # coil_burst commands go through, the rest is held back as one delivery of the newest value
+    assert mqtt_connection._loop.call_soon_threadsafe.call_count == 6
+    assert mqtt_connection._loop.call_soon_threadsafe.call_args.args == (mqtt_connection._deliver_held_command, ("nibe", "op-mode-47137"))
+    assert {reason: counter.value - dropped[reason] for reason, counter in commands_dropped.items()} == {
+        "retained": 1,
+        "unknown_coil": 1,
+        "malformed": 2,
+        "rate_limited": 0,
+    }
+
+
+async def test_last_command_over_coil_limit_is_delivered():
+    config = schema(
+        {
+            "mqtt": {"host": "127.0.0.1", "commands": {"coil_rate": 20, "coil_burst": 2}},
+            "nibe": {"nibegw": {"ip": "127.0.0.1"}, "model": "F1255"},
+        }
+    )
+    handler = mock.Mock()
+    connection = MqttConnection(handler, config["mqtt"])
+    connection._loop = asyncio.get_running_loop()
+
+    # A slider drag: only the first values fit the coil budget, the final one must still reach the pump
+    for value in (b"20", b"21", b"22", b"23", b"24"):
+        connection._on_message_cb(None, None, mock.Mock(topic="nibe/coils/heat-offset-s1-47011/set", payload=value, retain=False))
+    await asyncio.sleep(0.2)
+
+    assert [call.args for call in handler.handle_coil_set.call_args_list] == [
+        ("heat-offset-s1-47011", "20"),
+        ("heat-offset-s1-47011", "21"),
+        ("heat-offset-s1-47011", "24"),
+    ]
+
+
+async def test_asyncio_network_loop_drives_socket_from_event_loop():
+    config = schema({"mqtt": {"host": "127.0.0.1", "network_loop": "asyncio"}, "nibe": {"nibegw": {"ip": "127.0.0.1"}, "model": "F1255"}})
+    handler = mock.Mock()
+    connection = MqttConnection(handler, config["mqtt"])
+    connection._loop = asyncio.get_running_loop()
+    connection._socket_closed = asyncio.Event()
+    client = connection._client = mock.Mock(loop_misc=mock.Mock(return_value=MQTTErrorCode.MQTT_ERR_SUCCESS))
+
+    sock, peer = socket.socketpair()
+    with sock, peer:
+        connection._on_socket_open_cb(client, None, sock)
+        connection._on_socket_register_write_cb(client, None, sock)
+        peer.send(b"x")
+        await asyncio.sleep(0.01)
+        client.loop_read.assert_called()
+        client.loop_write.assert_called()
+        client.loop_misc.assert_called()
+
+        connection._on_socket_unregister_write_cb(client, None, sock)
+        connection._on_socket_close_cb(client, None, sock)
+        assert connection._socket_closed.is_set()
+        assert connection._misc_task is None
+
+    connection._on_message_cb(client, None, mock.Mock(topic="nibe/coils/hw-comfort-48120/set", payload=b"ECONOMY", retain=False))
+    handler.handle_coil_set.assert_called_once_with("hw-comfort-48120", "ECONOMY")
+
+
+async def test_asyncio_network_loop_connects_off_the_event_loop():
+    config = schema({"mqtt": {"host": "127.0.0.1", "network_loop": "asyncio"}, "nibe": {"nibegw": {"ip": "127.0.0.1"}, "model": "F1255"}})
+    connection = MqttConnection(mock.Mock(), config["mqtt"])
+    connection._loop = asyncio.get_running_loop()
+    client = connection._client = mock.Mock(loop_misc=mock.Mock(return_value=MQTTErrorCode.MQTT_ERR_SUCCESS))
+    sock, peer = socket.socketpair()
+    connect_threads = []
+
+    def connect(host, port):
+        # paho opens the socket and queues CONNECT from within connect()
+        connect_threads.append(threading.get_ident())
+        connection._on_socket_open_cb(client, None, sock)
+        connection._on_socket_register_write_cb(client, None, sock)
+
+    client.connect.side_effect = connect
+    with sock, peer:
+        task = asyncio.create_task(connection._network_loop())
+        peer.send(b"x")
+        await asyncio.sleep(0.05)
+
+        assert connect_threads and connect_threads[0] != threading.get_ident()
+        client.loop_read.assert_called()
+        client.loop_write.assert_called()
+
+        connection._on_socket_unregister_write_cb(client, None, sock)
+        connection._on_socket_close_cb(client, None, sock)
+        task.cancel()
+
+
+async def test_state_is_buffered_while_disconnected_and_flushed_on_connect(mqtt_connection):
+    mqtt_connection._loop = asyncio.get_running_loop()
+    coil = Coil(address=40004, name="bt1-outdoor-temperature-40004", title="BT1", size="s16", factor=10)
+
+    for value in (1.0, 2.0, 3.0):
+        mqtt_connection.publish_coil_state(CoilData(coil, value))
+    mqtt_connection._client.publish.assert_not_called()
+    assert mqtt_connection.outbox_stats["depth"] == 1
+
+    mqtt_connection._on_connect_cb(mqtt_connection._client, None, {}, 0)
+    await asyncio.sleep(0.05)
+
+    assert mqtt_connection._client.publish.call_args.args == ("nibe/coils/bt1-outdoor-temperature-40004", 3.0)
+    assert mqtt_connection.outbox_stats == {"depth": 0, "dropped": 0, "flushed": 1}
+
+
+async def test_outbox_is_flushed_after_broker_drops_connection():
+    broker = FakeBroker()
+    port = await broker.start()
+    config = schema({"mqtt": {"host": "127.0.0.1", "port": port}, "nibe": {"nibegw": {"ip": "127.0.0.1"}, "model": "F1255"}})
+    connection = MqttConnection(mock.Mock(), config["mqtt"])
+    coil = Coil(address=40004, name="bt1-outdoor-temperature-40004", title="BT1", size="s16", factor=10)
+    try:
+        connection.start()
+        await _wait_for(lambda: connection._connected)
+
+        broker.drop_clients()
+        await _wait_for(lambda: not connection._connected)
+        connection.publish_coil_state(CoilData(coil, 3.0))
+        assert connection.outbox_stats["depth"] == 1
+
+        await _wait_for(lambda: ("nibe/coils/bt1-outdoor-temperature-40004", b"3.0") in broker.published)
+        assert broker.connects == 2
+        assert connection.outbox_stats["depth"] == 0
+    finally:
+        connection.stop()
+        await broker.close()
+
+
+async def test_aggregate_mode_publishes_one_document_per_window():
+    config = schema({"mqtt": {"host": "127.0.0.1", "aggregate": {"window": 0.05}}, "nibe": {"nibegw": {"ip": "127.0.0.1"}, "model": "F1255"}})
+    connection = MqttConnection(mock.Mock(), config["mqtt"])
+    connection._client = mock.Mock()
+    connection._connected = True
+    outdoor = Coil(address=40004, name="bt1-outdoor-temperature-40004", title="BT1", size="s16", factor=10)
+    mode = Coil(address=47137, name="op-mode-47137", title="Op mode", size="u8", write=True, mappings={"0": "AUTO", "1": "MANUAL"})
+
+    for value in (1.0, 2.0, 3.0):
+        connection.publish_coil_state(CoilData(outdoor, value))
+    connection.publish_coil_state(CoilData(mode, "MANUAL"))
+    connection._client.publish.assert_not_called()
+
+    await asyncio.sleep(0.1)
+    connection._client.publish.assert_called_once()
+    topic, payload = connection._client.publish.call_args.args
+    assert topic == "nibe/state"
+    assert json.loads(payload) == {"bt1-outdoor-temperature-40004": 3.0, "op-mode-47137": "MANUAL"}
+
+    _, discovery = connection.get_discovery(mode, DEVICE_INFO)
+    discovery = json.loads(discovery)
+    assert discovery["state_topic"] == "nibe/state"
+    assert discovery["value_template"] == "{{ value_json['op-mode-47137'] }}"
+    assert discovery["command_topic"] == "nibe/coils/op-mode-47137/set"
@@ -0,0 +1,33 @@
+from __future__ import annotations
+
+from nibe_mqtt.outbox import Outbox
+
+
+def test_outbox_keeps_latest_value_per_topic_and_drops_oldest():
+    outbox = Outbox(max_size=2)
+
+    outbox.put("nibe/coils/a", 1, True)
+    outbox.put("nibe/coils/b", 2, True)
+    outbox.put("nibe/coils/a", 3, True)
+    outbox.put("nibe/coils/c", 4, False)
+
+    assert outbox.stats() == {"depth": 2, "dropped": 1, "flushed": 0}
+    assert outbox.pop() == ("nibe/coils/a", 3, True)
+    assert outbox.pop() == ("nibe/coils/c", 4, False)
+    assert outbox.stats() == {"depth": 0, "dropped": 1, "flushed": 2}
+
+
+def test_outbox_spool_survives_restart(tmp_path):
+    spool = tmp_path / "outbox.json"
+    outbox = Outbox(max_size=10, spool=spool)
+    outbox.put("nibe/coils/a", 21.5, True)
+    outbox.put("nibe/coils/b", None, True)
+    outbox.save()
+
+    restored = Outbox(max_size=10, spool=spool)
+    restored.load()
+    assert restored.pop() == ("nibe/coils/a", "21.5", True)
+    assert restored.pop() == ("nibe/coils/b", "", True)
+
+    restored.save()
+    assert not spool.exists()
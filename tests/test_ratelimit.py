@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+from nibe_mqtt.ratelimit import TokenBucket
+
+
+def test_token_bucket_allows_burst_then_rate():
+    bucket = TokenBucket(rate=2, burst=3)
+    bucket._updated = 0.0
+
+    assert [bucket.allow(0.0) for _ in range(4)] == [True, True, True, False]
+    assert bucket.allow(0.25) is False
+    assert bucket.allow(0.5) is True
+    assert [bucket.allow(100.0) for _ in range(4)] == [True, True, True, False]
+
+
+def test_token_bucket_delay_until_next_token():
+    bucket = TokenBucket(rate=2, burst=1)
+    bucket._updated = 0.0
+
+    assert bucket.delay(0.0) == 0.0
+    assert bucket.allow(0.0)
+    assert bucket.delay(0.0) == 0.5
+    assert bucket.delay(0.25) == 0.25
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import asyncio
+from unittest import mock
+
+from nibe.connection.encoders import CoilDataEncoderModbus
+from nibe.exceptions import ReadIOException
+
+from nibe_mqtt.reader import ConcurrentCoilReader, ModbusBlockReader
+
+
+def _modbus_connection(registers):
+    connection = mock.Mock()
+    connection._send_lock = asyncio.Lock()
+    connection._slave_id = 1
+    connection._client.read_input_registers = mock.AsyncMock(side_effect=lambda slave_id, starting_address, quantity: registers[starting_address:][:quantity])
+    connection.coil_encoder = CoilDataEncoderModbus(word_swap=True)
+    return connection
+
+
+def test_plan_merges_contiguous_registers(make_coil):
+    coils = [make_coil(30004), make_coil(30001), make_coil(30002, size="u32", factor=1), make_coil(30010), make_coil(40001)]
+
+    blocks = ModbusBlockReader.plan(coils)
+
+    assert [(b.entity_type, b.start, b.count, len(b.coils)) for b in blocks] == [
+        (3, 0, 4, 3),
+        (3, 9, 1, 1),
+        (4, 0, 1, 1),
+    ]
+
+
+def test_plan_bridges_gaps_within_limits(make_coil):
+    coils = [make_coil(30001), make_coil(30004), make_coil(30007), make_coil(30012)]
+
+    blocks = ModbusBlockReader.plan(coils, max_gap=3, max_length=6)
+
+    # 30007 would stretch the first block past max_length, 30012 is too far from 30007
+    assert [(b.start, b.count, [c.address for c, _ in b.coils]) for b in blocks] == [(0, 4, [30001, 30004]), (6, 1, [30007]), (11, 1, [30012])]
+
+
+async def test_modbus_block_read_decodes_all_coils(make_coil):
+    connection = _modbus_connection([100, 5, 0, 250])
+    heatpump = mock.Mock()
+    read_coil = mock.AsyncMock()
+    coils = [make_coil(30001), make_coil(30002, size="u32", factor=1), make_coil(30004)]
+
+    failures = await ModbusBlockReader(connection, heatpump, read_coil).read_coils(coils)
+
+    assert failures == []
+    connection._client.read_input_registers.assert_awaited_once_with(slave_id=1, starting_address=0, quantity=4)
+    read_coil.assert_not_awaited()
+    values = {call.args[0].coil.address: call.args[0].value for call in heatpump.notify_coil_update.call_args_list}
+    assert values == {30001: 10.0, 30002: 5, 30004: 25.0}
+
+
+async def test_concurrent_reader_limits_in_flight_reads(make_coil):
+    in_flight = 0
+    max_in_flight = 0
+
+    async def read_coil(coil):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0)
+        in_flight -= 1
+        if coil.address == 40003:
+            raise TimeoutError("no response")
+
+    coils = [make_coil(40000 + i) for i in range(10)]
+    failures = await ConcurrentCoilReader(read_coil, 3).read_coils(coils)
+
+    assert max_in_flight == 3
+    assert [coil.address for coil, _ in failures] == [40003]
+
+
+async def test_failed_block_falls_back_to_single_reads(make_coil):
+    connection = _modbus_connection([])
+    connection._client.read_input_registers.side_effect = ReadIOException("illegal data address")
+    read_coil = mock.AsyncMock(side_effect=[None, TimeoutError("no response")])
+    coils = [make_coil(30001), make_coil(30003)]
+
+    failures = await ModbusBlockReader(connection, mock.Mock(), read_coil, max_gap=1).read_coils(coils)
+
+    assert [call.args[0] for call in read_coil.await_args_list] == coils
+    assert [coil.address for coil, _ in failures] == [30003]
+
+
+async def test_undecodable_block_value_falls_back_to_single_read(make_coil):
+    # 70000 does not fit a 16 bit register, the encoder raises OverflowError rather than DecodeException
+    connection = _modbus_connection([100, 70000])
+    heatpump = mock.Mock()
+    read_coil = mock.AsyncMock()
+    coils = [make_coil(30001), make_coil(30002)]
+
+    failures = await ModbusBlockReader(connection, heatpump, read_coil).read_coils(coils)
+
+    assert failures == []
+    read_coil.assert_awaited_once_with(coils[1])
+    assert [call.args[0].coil for call in heatpump.notify_coil_update.call_args_list] == [coils[0]]
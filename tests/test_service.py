@@ -1,12 +1,23 @@
 from __future__ import annotations
 
+import asyncio
+import time
 from unittest import mock
 
 import pytest
 from nibe.coil import CoilData
+from paho.mqtt.client import MQTTErrorCode
 
+from nibe_mqtt import cfg
 from nibe_mqtt.config import schema
-from nibe_mqtt.service import Service
+from nibe_mqtt.mqtt import MqttConnection
+from nibe_mqtt.service import (
+    ConfigReloader,
+    PollService,
+    Service,
+    create_services,
+    run_service,
+)
 
 
 @pytest.fixture
@@ -75,3 +86,288 @@ async def test_service_modbus(modbus_config):
     outdoor_temperature = service.heatpump.get_coil_by_address(30002)
     coil_data = CoilData(outdoor_temperature, 10)
     service.on_coil_update(coil_data)
+
+
+async def test_poll_service_schedules_per_coil_deadlines(modbus_config):
+    service = Service(modbus_config)
+    await service.heatpump.initialize()
+
+    outdoor = service.heatpump.get_coil_by_address(30002)
+    supply = service.heatpump.get_coil_by_address(30003)
+
+    async def read_coils(coils):
+        for coil in coils:
+            poller.register_update(coil)
+        return []
+
+    reader = mock.Mock(read_coils=mock.AsyncMock(side_effect=read_coils))
+    with mock.patch.object(service, "get_coil_reader", return_value=reader), mock.patch.object(PollService, "STARTUP_DELAY", 0):
+        now = time.monotonic()
+        poller = PollService(service, {"interval": 60, "batch": False, "concurrency": 4, "coils": [30002, {"coil": 30003, "interval": 10}]})
+
+    await poller._poll_due()
+
+    reader.read_coils.assert_awaited_once_with([outdoor, supply])
+    assert poller._queue[0][2] is supply
+    assert poller._deadlines[supply] == pytest.approx(now + 10, abs=1)
+    assert poller._deadlines[outdoor] == pytest.approx(now + 60, abs=1)
+
+    # An update pushed by the pump defers the next poll without touching the queue
+    with mock.patch("time.monotonic", return_value=now + 5):
+        poller.register_update(supply)
+    with mock.patch("time.monotonic", return_value=now + 10):
+        assert poller._pop_due() == []
+    assert poller._deadlines[supply] == now + 15
+
+
+async def test_poll_service_polls_changed_adaptive_coil_at_base_interval(modbus_config):
+    service = Service(modbus_config)
+    await service.heatpump.initialize()
+    outdoor = service.heatpump.get_coil_by_address(30002)
+
+    async def read_coils(coils):
+        for coil in coils:
+            poller.register_update(coil, 20.5)
+        return []
+
+    reader = mock.Mock(read_coils=mock.AsyncMock(side_effect=read_coils))
+    conf = {"interval": 60, "batch": False, "concurrency": 4, "adaptive": {"max_interval": 600, "backoff": 2}, "coils": [30002]}
+    with mock.patch.object(service, "get_coil_reader", return_value=reader), mock.patch.object(PollService, "STARTUP_DELAY", 0):
+        now = time.monotonic()
+        poller = PollService(service, conf)
+
+    # Stable value backs the interval off to 60, 120 and 240 seconds
+    for at in (now, now + 60, now + 180):
+        with mock.patch("time.monotonic", return_value=at):
+            await poller._poll_due()
+    assert poller._queue[0][0] == now + 420
+
+    poller._wakeup.clear()
+    with mock.patch("time.monotonic", return_value=now + 200):
+        poller.register_update(outdoor, 21.0)
+
+    assert poller._wakeup.is_set()
+    assert poller._queue[0][0] == now + 260
+    with mock.patch("time.monotonic", return_value=now + 260):
+        assert poller._pop_due() == [outdoor]
+
+
+async def test_poll_concurrency_defaults_to_bus_concurrency(nibegw_config):
+    nibegw_config["nibe"]["bus"]["concurrency"] = 2
+    service = Service(nibegw_config)
+    await service.heatpump.initialize()
+
+    with mock.patch.object(service, "get_coil_reader") as get_coil_reader:
+        PollService(
+            service,
+            schema({"mqtt": {"host": "127.0.0.1"}, "nibe": {**nibegw_config["nibe"], "model": "F1255", "poll": {"batch": True, "coils": [40004]}}})["nibe"][
+                "poll"
+            ],
+        )
+
+    get_coil_reader.assert_called_once_with(True, 2)
+
+
+async def test_poll_service_retries_coils_of_failing_reader(modbus_config):
+    service = Service(modbus_config)
+    await service.heatpump.initialize()
+
+    reader = mock.Mock(read_coils=mock.AsyncMock(side_effect=TypeError("unexpected register data")))
+    with mock.patch.object(service, "get_coil_reader", return_value=reader), mock.patch.object(PollService, "STARTUP_DELAY", 0):
+        now = time.monotonic()
+        poller = PollService(service, {"interval": 60, "batch": True, "concurrency": 4, "coils": [30002, 30003]})
+
+    await poller._poll_due()
+
+    assert sorted(poller._deadlines.values()) == pytest.approx([now + PollService.RETRY_DELAY] * 2, abs=1)
+
+
+async def test_two_heatpumps_share_connection_and_poller():
+    conf = schema(
+        {
+            "mqtt": {"host": "127.0.0.1"},
+            "nibe": [
+                {"prefix": "nibe/house", "model": "F1255", "nibegw": {"ip": "127.0.0.1"}, "poll": {"coils": [40004]}},
+                {"prefix": "nibe/garage", "model": "S1255", "nibegw": {"ip": "127.0.0.2"}, "poll": {"coils": [30002]}},
+            ],
+        }
+    )
+    house, garage = create_services(conf)
+    mqtt_client = house.mqtt_client
+    assert garage.mqtt_client is mqtt_client and garage.poller is house.poller
+
+    mqtt_client._loop = asyncio.get_running_loop()
+    for service in (house, garage):
+        await service.heatpump.initialize()
+        mqtt_client.set_writable_coils(service.prefix, service._get_writable_coil_names())
+        with mock.patch.object(service, "get_coil_reader"), mock.patch.object(PollService, "STARTUP_DELAY", 0):
+            service.poller.add_service(service, service.nibe_conf["poll"])
+
+    with mock.patch.object(house, "handle_coil_set") as house_set, mock.patch.object(garage, "handle_coil_set") as garage_set:
+        for topic in (
+            "nibe/house/coils/hot-water-comfort-mode-47041/set",
+            "nibe/garage/coils/period-time-hot-water-40093/set",
+            # writable on the house pump only, rejected under the garage prefix
+            "nibe/garage/coils/hot-water-comfort-mode-47041/set",
+        ):
+            mqtt_client._on_message_cb(None, None, mock.Mock(topic=topic, payload=b"1", retain=False))
+        await asyncio.sleep(0)
+
+    house_set.assert_called_once_with("hot-water-comfort-mode-47041", "1")
+    garage_set.assert_called_once_with("period-time-hot-water-40093", "1")
+
+    outdoor_house = house.heatpump.get_coil_by_address(40004)
+    outdoor_garage = garage.heatpump.get_coil_by_address(30002)
+    assert house.poller.get_coils(house) == [outdoor_house]
+    assert house.poller.get_coils(garage) == [outdoor_garage]
+    assert sorted(house.poller._pop_due(), key=lambda coil: coil.address) == [outdoor_garage, outdoor_house]
+
+
+async def test_announce_discovery_skips_retained_unchanged(modbus_config):
+    service = Service(modbus_config)
+    await service.heatpump.initialize()
+    service.poller.add_service(service, {"interval": 60, "batch": False, "concurrency": 4, "coils": [30002, 30003, 30004]})
+    service.mqtt_client._client = mock.Mock()
+    outdoor, supply, supply_ep22 = service.poller.get_coils(service)
+
+    unchanged_topic, unchanged_payload = service.mqtt_client.get_discovery(outdoor, service.device_info)
+    changed_topic, _ = service.mqtt_client.get_discovery(supply, service.device_info)
+    service.mqtt_client.fetch_retained_discovery = mock.AsyncMock(return_value={unchanged_topic: unchanged_payload, changed_topic: b"{}"})
+    service.announced_coils.add(supply_ep22)
+
+    await service._announce_discovery({"coils": "poll", "rate": 1000, "diff": True})
+
+    published = [call.args[0] for call in service.mqtt_client._client.publish.call_args_list]
+    assert published == [changed_topic]
+    assert service.announced_coils == {outdoor, supply, supply_ep22}
+
+
+async def test_announce_discovery_skips_statistics_only_coils():
+    config = schema(
+        {
+            "mqtt": {"host": "127.0.0.1", "statistics": {"coils": [{"coil": 30002, "raw": False}]}},
+            "nibe": {"modbus": {"url": "tcp://127.0.0.1:502", "slave_id": 1}, "model": "S2125"},
+        }
+    )
+    service = Service(config)
+    await service.heatpump.initialize()
+    service.poller.add_service(service, {"interval": 60, "batch": False, "concurrency": 4, "coils": [30002, 30003]})
+    service.mqtt_client._client = mock.Mock()
+    outdoor, supply = service.poller.get_coils(service)
+
+    await service._announce_discovery({"coils": "poll", "rate": 1000, "diff": False})
+
+    published = [call.args[0] for call in service.mqtt_client._client.publish.call_args_list]
+    assert published == [service.mqtt_client.get_discovery(supply, service.device_info)[0]]
+    assert outdoor not in service.announced_coils
+
+
+async def test_warm_restart_from_snapshot(modbus_config, tmp_path):
+    modbus_config["nibe"]["snapshot"] = {"path": str(tmp_path / "state.jsonl"), "interval": 30}
+    poll_config = {"interval": 60, "batch": False, "concurrency": 4, "coils": [30002, 30003]}
+
+    service = Service(modbus_config)
+    await service.heatpump.initialize()
+    service.mqtt_client._client = mock.Mock()
+    service.mqtt_client._client.publish.return_value.rc = MQTTErrorCode.MQTT_ERR_SUCCESS
+    outdoor = service.heatpump.get_coil_by_address(30002)
+    service.on_coil_update(CoilData(outdoor, 10.5))
+    service.snapshot.save()
+
+    restarted = Service(modbus_config)
+    restarted.mqtt_client._client = mock.Mock()
+    with mock.patch.object(restarted, "_snapshot_loop", mock.AsyncMock()), mock.patch.dict(restarted.nibe_conf, poll=poll_config):
+        await restarted.start()
+    restarted.mqtt_client.stop()
+
+    outdoor = restarted.heatpump.get_coil_by_address(30002)
+    supply = restarted.heatpump.get_coil_by_address(30003)
+    assert restarted.mqtt_client._outbox.pop() == ("nibe/coils/" + outdoor.name, 10.5, True)
+    assert outdoor in restarted.announced_coils
+
+    # Fresh value is not polled until its interval passes, unknown coil is polled right after startup
+    now = time.monotonic()
+    assert restarted.poller._deadlines[outdoor] == pytest.approx(now + 60, abs=1)
+    assert restarted.poller._deadlines[supply] == pytest.approx(now + PollService.STARTUP_DELAY, abs=1)
+
+
+async def test_snapshot_keeps_no_discovery_hash_of_unsent_config(modbus_config, tmp_path):
+    modbus_config["nibe"]["snapshot"] = {"path": str(tmp_path / "state.jsonl"), "interval": 30}
+    service = Service(modbus_config)
+    await service.heatpump.initialize()
+    service.mqtt_client._client = mock.Mock()
+    outdoor = service.heatpump.get_coil_by_address(30002)
+
+    service.mqtt_client._client.publish.return_value.rc = MQTTErrorCode.MQTT_ERR_NO_CONN
+    service._publish_discovery(outdoor)
+    assert "discovery" not in service.snapshot.get(outdoor.name)
+
+    service.mqtt_client._client.publish.return_value.rc = MQTTErrorCode.MQTT_ERR_SUCCESS
+    service._publish_discovery(outdoor)
+    assert "discovery" in service.snapshot.get(outdoor.name)
+
+
+async def test_config_reload_updates_polling_in_place(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    base = "mqtt:\n  host: 127.0.0.1\n{mqtt}nibe:\n  model: F1255\n  nibegw:\n    ip: {ip}\n  poll:\n    coils:\n{coils}"
+    config_file.write_text(base.format(mqtt="", ip="127.0.0.1", coils="      - 40004\n      - 40008\n"))
+    service = Service(cfg.load(config_file, cache=False))
+    await service.heatpump.initialize()
+    connection, mqtt_client = service.connection, service.mqtt_client
+    with mock.patch.object(service, "get_coil_reader"):
+        service.poller.add_service(service, service.nibe_conf["poll"])
+    outdoor, supply, hw_top = (service.heatpump.get_coil_by_address(address) for address in (40004, 40008, 40013))
+    service.poller.register_update(outdoor)
+
+    reloader = ConfigReloader(config_file, [service])
+    config_file.write_text(base.format(mqtt="  retain_state: false\n", ip="127.0.0.2", coils="      - 40004\n      - coil: 40013\n        interval: 10\n"))
+    with mock.patch.object(service, "get_coil_reader"), mock.patch("nibe_mqtt.service.logger") as logger:
+        reloader.reload()
+
+    logger.warning.assert_called_once_with("Configuration changes of nibe.nibegw require a restart")
+    assert service.poller.get_coils(service) == [outdoor, hw_top]
+    assert supply not in service.poller._deadlines
+    assert service.poller._deadlines[outdoor] == pytest.approx(time.monotonic() + 60, abs=1)
+    assert service.poller._intervals[hw_top] == 10
+    assert mqtt_client._conf["retain_state"] is False
+    assert service.connection is connection and service.mqtt_client is mqtt_client
+    assert service.nibe_conf["nibegw"]["ip"] == "127.0.0.1"
+    with mock.patch("time.monotonic", return_value=time.monotonic() + PollService.STARTUP_DELAY):
+        assert service.poller._pop_due() == [hw_top]
+
+
+async def test_config_reload_keeps_polling_on_unknown_coil(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    base = "mqtt:\n  host: 127.0.0.1\nnibe:\n  model: F1255\n  nibegw:\n    ip: 127.0.0.1\n  poll:\n    coils:\n{coils}"
+    config_file.write_text(base.format(coils="      - bt1-outdoor-temperature-40004\n"))
+    service = Service(cfg.load(config_file, cache=False))
+    await service.heatpump.initialize()
+    with mock.patch.object(service, "get_coil_reader"):
+        service.poller.add_service(service, service.nibe_conf["poll"])
+    running = service.nibe_conf["poll"]
+
+    reloader = ConfigReloader(config_file, [service])
+    config_file.write_text(base.format(coils="      - 40013\n      - bt1-outdoor-temprature-40004\n"))
+    with mock.patch("nibe_mqtt.service.logger") as logger:
+        reloader.reload()
+
+    assert "keeping the running one" in logger.error.call_args.args[0]
+    assert service.poller.get_coils(service) == [service.heatpump.get_coil_by_address(40004)]
+    assert service.nibe_conf["poll"] is running
+
+
+async def test_run_service_saves_buffered_state_on_shutdown(tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        f"mqtt:\n  host: 127.0.0.1\nnibe:\n  model: F1255\n  nibegw:\n    ip: 127.0.0.1\n  snapshot:\n    path: {tmp_path / 'state.jsonl'}\n"
+    )
+
+    with mock.patch.object(Service, "start", mock.AsyncMock()), mock.patch.object(MqttConnection, "stop") as mqtt_stop:
+        task = asyncio.create_task(run_service(config_file))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    mqtt_stop.assert_called_once()
+    assert (tmp_path / "state.jsonl").exists()
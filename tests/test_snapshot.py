@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+from nibe_mqtt.snapshot import StateSnapshot
+
+
+def test_snapshot_appends_changes_and_compacts(tmp_path):
+    path = tmp_path / "state.jsonl"
+    snapshot = StateSnapshot(path)
+    snapshot.update("bt1-outdoor-temperature-40004", value=1.5, time=100.0)
+    snapshot.update("bt2-supply-temp-s1-40008", value=30.1, time=100.0)
+    snapshot.save()
+
+    snapshot.update("bt1-outdoor-temperature-40004", value=2.0, time=160.0)
+    snapshot.save()
+    assert not snapshot.dirty
+    assert len(path.read_text().splitlines()) == 3
+
+    with path.open("a") as fh:
+        fh.write('{"name": "truncated')
+
+    restored = StateSnapshot(path)
+    restored.load()
+    assert restored.get("bt1-outdoor-temperature-40004") == {"value": 2.0, "time": 160.0}
+    assert len(restored) == 2
+
+    for i in range(10):
+        restored.update("bt1-outdoor-temperature-40004", value=i, time=200.0 + i)
+        restored.save()
+    assert len(path.read_text().splitlines()) <= StateSnapshot.COMPACT_RATIO * len(restored)
@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+from nibe_mqtt.config import schema
+from nibe_mqtt.statistics import StatisticsAggregator
+
+
+def _aggregator(coils, windows=(60, 180)):
+    conf = schema(
+        {"mqtt": {"host": "127.0.0.1", "statistics": {"windows": list(windows), "coils": coils}}, "nibe": {"nibegw": {"ip": "127.0.0.1"}, "model": "F1255"}}
+    )
+    return StatisticsAggregator(conf["mqtt"]["statistics"])
+
+
+def test_windows_slide_over_buckets(make_coil):
+    coil = make_coil(40004, "bt1-outdoor-temperature-40004")
+    aggregator = _aggregator([40004])
+    assert aggregator.labels == ["1m", "3m"]
+
+    results = []
+    for values in ([1.0, 3.0], [5.0], [], [9.0]):
+        for value in values:
+            aggregator.add(coil, value)
+        results.append(aggregator.roll()[coil])
+
+    assert results[0]["1m"] == {"min": 1.0, "mean": 2.0, "max": 3.0, "last": 3.0, "count": 2}
+    assert results[1]["3m"] == {"min": 1.0, "mean": 3.0, "max": 5.0, "last": 5.0, "count": 3}
+    assert "1m" not in results[2]
+    # the first bucket has left the 3 minute window
+    assert results[3]["3m"] == {"min": 5.0, "mean": 7.0, "max": 9.0, "last": 9.0, "count": 2}
+
+
+def test_untracked_and_non_numeric_values_are_ignored(make_coil):
+    tracked = make_coil(40004, "bt1-outdoor-temperature-40004")
+    other = make_coil(40008, "bt2-supply-temp-s1-40008")
+    aggregator = _aggregator([{"coil": "bt1-outdoor-temperature-40004", "raw": False}])
+
+    aggregator.add(tracked, "ON")
+    aggregator.add(other, 12.0)
+
+    assert aggregator.roll() == {}
+    assert not aggregator.publishes_raw(tracked)
+    assert aggregator.publishes_raw(other)
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+from nibe.coil import Coil, CoilData
+
+from nibe_mqtt.watchdog import LoopWatchdog
+
+
+def _busy_update(coil_data: CoilData, seconds: float):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+async def test_blocked_loop_is_reported_with_involved_coil():
+    reports = []
+    watchdog = LoopWatchdog(threshold=0.05, on_slow=reports.append)
+    watchdog.start()
+    try:
+        await asyncio.sleep(0.05)
+        coil = Coil(address=40004, name="bt1-outdoor-temperature-40004", title="BT1", size="s16", factor=10)
+        _busy_update(CoilData(coil, 1.0), 0.2)
+        await asyncio.sleep(0.05)
+    finally:
+        watchdog.stop()
+
+    assert len(reports) == 1
+    assert reports[0]["lag"] >= 0.1
+    assert reports[0]["involved"] == "coil bt1-outdoor-temperature-40004"
+    assert any("_busy_update" in line for line in reports[0]["stack"])
+
+
+async def test_profile_writes_collapsed_stacks(tmp_path):
+    watchdog = LoopWatchdog(sample_interval=0.001, profile_dir=tmp_path)
+    watchdog.start()
+    try:
+        assert watchdog.profile(0.1)
+        assert not watchdog.profile(0.1)
+        _busy_update(None, 0.05)
+        await asyncio.sleep(0.15)
+    finally:
+        watchdog.stop()
+
+    (path,) = tmp_path.glob("profile-*.folded")
+    lines = path.read_text().splitlines()
+    assert any("_busy_update (test_watchdog.py:" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
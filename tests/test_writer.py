@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import asyncio
+from unittest import mock
+
+from nibe.coil import CoilData
+
+from nibe_mqtt.writer import WriteQueue
+
+
+async def test_pending_writes_are_coalesced_and_read_back_together(make_coil):
+    written = []
+    write_started = asyncio.Event()
+    release_write = asyncio.Event()
+
+    async def write_coil(coil_data):
+        written.append((coil_data.coil.address, coil_data.value))
+        write_started.set()
+        await release_write.wait()
+        return True
+
+    reader = mock.Mock(read_coils=mock.AsyncMock(return_value=[]))
+    queue = WriteQueue(write_coil, reader, concurrency=1, readback_delay=0.01)
+    heat_offset, cool_offset = make_coil(47011, write=True), make_coil(48739, write=True)
+
+    queue.submit(CoilData(heat_offset, 1.0))
+    await write_started.wait()
+    for value in (2.0, 3.0, 4.0):
+        queue.submit(CoilData(heat_offset, value))
+    queue.submit(CoilData(cool_offset, 1.0))
+    release_write.set()
+
+    await asyncio.sleep(0.05)
+
+    assert sorted(written) == [(47011, 1.0), (47011, 4.0), (48739, 1.0)]
+    reader.read_coils.assert_awaited_once()
+    assert set(reader.read_coils.await_args.args[0]) == {heat_offset, cool_offset}
+
+
+async def test_update_with_written_value_confirms_without_read_back(make_coil):
+    statuses = []
+    reader = mock.Mock(read_coils=mock.AsyncMock(return_value=[]))
+    write_coil = mock.AsyncMock(side_effect=lambda coil_data: coil_data.coil.address != 48739)
+    queue = WriteQueue(write_coil, reader, concurrency=1, readback_delay=0.02, on_status=lambda coil, status: statuses.append((coil.address, status)))
+    heat_offset, cool_offset = make_coil(47011, write=True), make_coil(48739, write=True)
+
+    queue.submit(CoilData(heat_offset, 2.0))
+    queue.submit(CoilData(cool_offset, 1.0))
+    await asyncio.sleep(0)
+    queue.on_coil_update(CoilData(heat_offset, 1.0))  # stale push
+    queue.on_coil_update(CoilData(heat_offset, 2.0))
+    await asyncio.sleep(0.05)
+
+    reader.read_coils.assert_not_awaited()
+    assert [(address, status["state"], status.get("via")) for address, status in statuses] == [(48739, "failed", None), (47011, "confirmed", "update")]
+
+
+async def test_read_back_reports_mismatch(make_coil):
+    statuses = []
+    heat_offset = make_coil(47011, write=True)
+    queue = None
+
+    async def read_coils(coils):
+        queue.on_coil_update(CoilData(heat_offset, 1.0))
+        return []
+
+    reader = mock.Mock(read_coils=read_coils)
+    queue = WriteQueue(mock.AsyncMock(return_value=True), reader, concurrency=1, readback_delay=0, on_status=lambda coil, status: statuses.append(status))
+
+    queue.submit(CoilData(heat_offset, 2.0))
+    await asyncio.sleep(0.01)
+
+    assert statuses == [{"value": 2.0, "state": "mismatch", "latency": mock.ANY, "via": "readback", "actual": 1.0}]